@@ -0,0 +1,70 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Microbenchmark for nametagbot.chat.parse_content.
+
+Parses every message in a corpus, one message per line, and reports the
+time per message.  Lines starting with # are ignored.  Run it from the
+repository root with:
+
+    PYTHONPATH=. python benchmarks/parse_content.py
+
+"""
+
+import argparse
+import os
+import timeit
+
+from nametagbot.chat import parse_content
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument(
+        'corpus',
+        nargs='?',
+        default=os.path.join(os.path.dirname(__file__), 'chat_corpus.txt'),
+        help='corpus file path')
+    p.add_argument(
+        '-n',
+        '--number',
+        type=int,
+        default=1000,
+        help='number of passes over the corpus per run')
+    p.add_argument(
+        '-r', '--repeat', type=int, default=5, help='number of runs')
+    args = p.parse_args()
+
+    with open(args.corpus) as f:
+        messages = [
+            line.rstrip('\n') for line in f if not line.startswith('#')
+        ]
+
+    matched = sum(1 for m in messages if parse_content(m) is not None)
+    print('{} messages, {} with an intent'.format(len(messages), matched))
+
+    def parse_all():
+        for message in messages:
+            parse_content(message)
+
+    best = min(
+        timeit.repeat(parse_all, number=args.number, repeat=args.repeat))
+    print('{:.2f} us per message'.format(
+        best / args.number / len(messages) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
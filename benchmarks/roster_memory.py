@@ -0,0 +1,75 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Benchmark of the memory used to hold a large roster's users.
+
+Fills a temporary roster with synthetic server members, then reads them
+back as a list of Users and as UserColumns, and reports the memory and time
+each takes.  Run it from the repository root with:
+
+    PYTHONPATH=. python benchmarks/roster_memory.py
+
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from nametagbot import User
+from nametagbot.data import Roster
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument(
+        '-u', '--users', type=int, default=100000, help='number of users')
+    args = p.parse_args()
+
+    rng = random.Random(0)
+    users = [
+        User(
+            str(rng.randrange(10**17, 10**18)), 'member{}'.format(i),
+            '{:04}'.format(rng.randrange(1, 10000)),
+            '{:032x}'.format(rng.getrandbits(128))
+            if rng.random() < 0.7 else '') for i in range(args.users)
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with Roster(os.path.join(tmp, 'roster.db')) as roster:
+            roster.update_users(users)
+            del users
+
+            for name, export in [
+                ('list of Users', lambda: list(roster.iter_users())),
+                ('UserColumns', roster.export_columns),
+            ]:
+                tracemalloc.start()
+                start = time.perf_counter()
+                exported = export()
+                seconds = time.perf_counter() - start
+                size, _ = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                print('{:>14}: {:8.1f} MiB, {:4.0f} bytes per user, '
+                      '{:.2f} s'.format(name, size / 2**20,
+                                        size / len(exported), seconds))
+                del exported
+
+
+if __name__ == '__main__':
+    main()
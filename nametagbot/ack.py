@@ -0,0 +1,170 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import asyncio
+from collections import namedtuple, OrderedDict
+import logging
+import time
+
+__all__ = ['Acknowledger', 'Completion', 'RateLimiter']
+
+# Acknowledgements sent per second, and in a burst, which keeps the bot
+# within Discord's rate limits for reactions.
+ACK_RATE = 4
+ACK_BURST = 5
+
+# Channels with more than this many requests awaiting acknowledgement get
+# a single summary reply rather than a reaction to each request.
+SUMMARY_THRESHOLD = 3
+
+# A message committed to the roster by the actor, for the request (such as
+# a chat message) identified by token, and the time it was submitted.
+Completion = namedtuple('Completion', ['token', 'message', 'submitted'])
+
+
+class RateLimiter:
+    """Token bucket rate limiter for coroutines."""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    async def acquire(self):
+        """Waits until an action is allowed."""
+        while True:
+            now = self.clock()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Acknowledger:
+    """Acknowledges requests once the roster actor has committed them.
+
+    The actor calls complete from its own thread, which hands completions
+    to the event loop.  run acknowledges them there: each request is
+    acknowledged by the react coroutine, except that when a burst leaves
+    more than SUMMARY_THRESHOLD requests waiting in a channel, they're
+    acknowledged together by one call to the reply coroutine, with a
+    summary of the changes.  Requests are tokens with a channel attribute,
+    such as Discord messages.
+
+    Acknowledgements are rate-limited by limiter, and the time from each
+    request's submission to its acknowledgement is observed in
+    request_ack_seconds.
+
+    """
+
+    def __init__(self, loop, react, reply, metrics, limiter=None):
+        self.loop = loop
+        self.react = react
+        self.reply = reply
+        self.metrics = metrics
+        self.limiter = limiter or RateLimiter(ACK_RATE, ACK_BURST)
+        self.completions = asyncio.Queue()
+
+    def complete(self, completions):
+        """Hands completions to the event loop.  Threadsafe.
+
+        Completions arriving after the event loop has closed are dropped.
+
+        """
+        try:
+            self.loop.call_soon_threadsafe(self.completions.put_nowait,
+                                           list(completions))
+        except RuntimeError:
+            logging.info('Not acknowledging %d requests after shutdown',
+                         len(completions))
+
+    def stop(self):
+        """Stops run once it's acknowledged earlier completions.
+
+        Threadsafe.
+
+        """
+        self.loop.call_soon_threadsafe(self.completions.put_nowait, None)
+
+    async def run(self):
+        while True:
+            completions = await self.completions.get()
+            stopping = completions is None
+            completions = completions or []
+            while not stopping and not self.completions.empty():
+                more = self.completions.get_nowait()
+                stopping = more is None
+                completions.extend(more or [])
+
+            await self._acknowledge(completions)
+            if stopping:
+                return
+
+    async def _acknowledge(self, completions):
+        # {channel: {request: [Completion]}}, in order of arrival.
+        channels = OrderedDict()
+        for completion in completions:
+            requests = channels.setdefault(completion.token.channel,
+                                           OrderedDict())
+            requests.setdefault(completion.token, []).append(completion)
+
+        for channel, requests in channels.items():
+            if len(requests) > SUMMARY_THRESHOLD:
+                await self._send(self.reply, 'acks_summaries',
+                                 requests.values(), channel,
+                                 _summary(requests.values()))
+                continue
+
+            for request, request_completions in requests.items():
+                await self._send(self.react, 'acks_reactions',
+                                 [request_completions], request)
+
+    async def _send(self, send, counter, requests, *args):
+        await self.limiter.acquire()
+        try:
+            await send(*args)
+        except Exception as e:
+            logging.warning('Error acknowledging request: %s', e)
+            self.metrics.increment('acks_failed')
+            return
+
+        self.metrics.increment(counter)
+        now = time.time()
+        for request_completions in requests:
+            self.metrics.observe(
+                'request_ack_seconds',
+                now - min(c.submitted for c in request_completions))
+
+
+def _summary(requests):
+    """Describes the changes made for several requests."""
+    nicks = OrderedDict([('ATTENDING', []), ('NOT_ATTENDING', [])])
+    for request_completions in requests:
+        for completion in request_completions:
+            kind, _, user = completion.message
+            nicks[kind].append(user.nick)
+
+    lines = []
+    if nicks['ATTENDING']:
+        lines.append('Added nametags for {}.'.format(', '.join(
+            nicks['ATTENDING'])))
+    if nicks['NOT_ATTENDING']:
+        lines.append('Cancelled nametags for {}.'.format(', '.join(
+            nicks['NOT_ATTENDING'])))
+    return '\n'.join(lines)
@@ -0,0 +1,422 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from collections import namedtuple
+import logging
+from queue import Empty, Full, Queue
+import sqlite3
+import threading
+import time
+
+from .ack import Completion
+from .index import RosterIndex
+
+__all__ = ['Envelope', 'RosterActor', 'roster_actor']
+
+# How often the actor logs its metrics, in seconds.
+METRICS_INTERVAL = 60
+
+# Message kinds that are spooled to disk, so they survive a crash.  Profile
+# changes aren't, because nametagbot-updateroster reconciles them.
+DURABLE_KINDS = ['ATTENDING', 'NOT_ATTENDING']
+
+# How many times a write is attempted while the database is busy, and the
+# delay before the first retry, which doubles after each attempt.
+BUSY_ATTEMPTS = 5
+BUSY_DELAY = 0.1
+
+# Delay before restarting a failed actor, which doubles after each failure
+# up to MAX_RESTART_DELAY.
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+
+# How often stop checks whether a full queue's actor is still running.
+STOP_POLL_INTERVAL = 0.1
+
+# Histogram buckets for batch sizes.
+_SIZE_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+# A message on the actor's queue, with its spool seq (or None if it isn't
+# durable), the time it was submitted, and the token of the request to
+# acknowledge once it's committed (or None).
+Envelope = namedtuple('Envelope', ['seq', 'time', 'message', 'token'])
+
+
+class RosterActor:
+    """Supervised roster actor thread.
+
+    Messages are submitted to a queue bounded by config.roster_queue_size,
+    and durable messages are appended to the spool first.  A full queue
+    never blocks the submitter: durable messages are left in the spool for
+    the actor to replay once it catches up, and others are dropped.
+
+    If the actor fails, it's restarted after a backoff, and replays the
+    messages in the spool that it hadn't committed.  The roster is opened
+    once by start, so that configuration and schema errors are raised
+    there rather than restarting the actor forever.
+
+    Attendance messages submitted with a token are passed to on_commit as
+    ack.Completions once they're committed.
+
+    The actor keeps index, a RosterIndex of the roster, which can answer
+    queries from any thread once it's loaded.
+
+    """
+
+    def __init__(self, config, metrics, spool, on_commit=None):
+        self.config = config
+        self.metrics = metrics
+        self.spool = spool
+        self.on_commit = on_commit
+        self.messages = Queue(maxsize=config.roster_queue_size)
+        self.overflowed = threading.Event()
+        self.index = RosterIndex()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._supervise)
+
+    def start(self):
+        self.config.get_roster().close()
+        self.thread.start()
+
+    def submit(self, message, token=None):
+        """Submits a message without blocking.
+
+        Returns False if the message was dropped because the queue is full.
+        Messages that overflow the queue are replayed from the spool, which
+        doesn't keep their tokens, so they aren't acknowledged.
+
+        """
+        now = time.time()
+        seq = None
+        if message[0] in DURABLE_KINDS:
+            seq = self.spool.append(message, now)
+
+        try:
+            self.messages.put_nowait(Envelope(seq, now, message, token))
+        except Full:
+            self.metrics.increment('roster_queue_full')
+            if seq is not None:
+                self.overflowed.set()
+                return True
+            logging.warning('Roster queue is full; dropping %s', message)
+            return False
+        return True
+
+    def stop(self):
+        """Asks the actor to quit, and waits for it.
+
+        An actor waiting to be restarted isn't restarted.
+
+        """
+        self.stopping.set()
+        quit = Envelope(None, time.time(), ('QUIT', ), None)
+        while self.thread.is_alive():
+            try:
+                self.messages.put(quit, timeout=STOP_POLL_INTERVAL)
+                break
+            except Full:
+                pass
+        if self.thread.ident is not None:
+            self.thread.join()
+
+    def _supervise(self):
+        delay = RESTART_DELAY
+        while not self.stopping.is_set():
+            start = time.monotonic()
+            try:
+                roster_actor(self.config, self.messages, self.metrics,
+                             self.spool, self.overflowed, self.on_commit,
+                             self.index)
+                return
+            except Exception:
+                logging.exception(
+                    'Roster actor failed; restarting in %g seconds', delay)
+                self.metrics.increment('roster_actor_restarts')
+
+            # An actor that ran for a while before failing starts over with
+            # a short delay.
+            if time.monotonic() - start > MAX_RESTART_DELAY:
+                delay = RESTART_DELAY
+            self.stopping.wait(delay)
+            delay = min(delay * 2, MAX_RESTART_DELAY)
+
+
+def roster_actor(config,
+                 messages,
+                 metrics,
+                 spool,
+                 overflowed=None,
+                 on_commit=None,
+                 index=None):
+    """Act on messages for the roster.
+
+    The Roster class is not thread-safe, so we use a single actor thread to
+    serialize messages for the database.  The queue holds Envelopes, whose
+    messages can be:
+
+    ('QUIT')
+    ('ATTENDING', server_id, User(...))
+    ('NOT_ATTENDING', server_id, User(...))
+    ('PROFILE', server_id, User(...))
+    ('REMOVED', server_id, user_id)
+
+    Messages are taken off the queue in batches of up to
+    config.roster_batch_size, waiting at most config.roster_batch_window
+    seconds for a batch to fill, and each batch is committed in a single
+    transaction per server.  Durable messages are acknowledged in the spool
+    once they're committed.  On starting, and whenever overflowed is set,
+    the unacknowledged messages in the spool are replayed first, and their
+    copies on the queue skipped.  Writes are retried while the database is
+    busy.  Committed attendance messages with tokens are passed to
+    on_commit, and the time since they were submitted is observed in
+    request_commit_seconds.
+
+    PROFILE messages report changes to server members' nicks and avatars.
+    They're coalesced per user, and written config.profile_debounce seconds
+    after the first pending one arrives, so a burst of changes costs one
+    write per user.  A user's pending profile is dropped when they leave
+    the server, or superseded by the profile in an attendance message.
+
+    Every config.compaction_interval seconds, the roster's history older
+    than config.history_retention seconds is compacted.
+
+    The index, a RosterIndex, is loaded when the actor starts and after
+    each compaction, and every committed change is written through to it.
+    Attendance messages and profiles that wouldn't change the index are
+    counted in roster_noop_writes and not written at all.
+
+    """
+    logging.info('Roster actor is starting')
+
+    last_metrics = time.monotonic()
+    next_compaction = time.monotonic()
+    profiles = {}
+    next_flush = None
+    replay = True
+    last_seq = 0
+    if index is None:
+        index = RosterIndex()
+    with config.get_roster() as roster:
+        while True:
+            if time.monotonic() >= next_compaction:
+                _retry_busy(metrics, roster.compact,
+                            time.time() - config.history_retention)
+                index.load(roster)
+                metrics.set_gauge('roster_index_users', len(index))
+                next_compaction = (
+                    time.monotonic() + config.compaction_interval)
+
+            if overflowed is not None and overflowed.is_set():
+                overflowed.clear()
+                replay = True
+
+            if replay:
+                batch = [
+                    Envelope(seq, t, message, None)
+                    for seq, t, message in spool.pending(
+                        after=last_seq, limit=config.roster_batch_size)
+                ]
+                if batch:
+                    logging.info('Replaying %d spooled roster messages',
+                                 len(batch))
+                replay = len(batch) == config.roster_batch_size
+            else:
+                # Wake up to log metrics even while idle, since they count
+                # chat messages that never reach the actor.
+                deadline = min(next_compaction,
+                               last_metrics + METRICS_INTERVAL)
+                if next_flush is not None:
+                    deadline = min(deadline, next_flush)
+                batch = _next_batch(
+                    messages,
+                    config.roster_batch_size,
+                    config.roster_batch_window,
+                    timeout=max(0, deadline - time.monotonic()))
+
+            # Messages replayed from the spool may still be on the queue.
+            # They've been committed, but their tokens weren't known until
+            # now.
+            replayed = [
+                envelope for envelope in batch
+                if envelope.seq is not None and envelope.seq <= last_seq
+            ]
+            batch = [
+                envelope for envelope in batch
+                if envelope.seq is None or envelope.seq > last_seq
+            ]
+            last_seq = max([last_seq] + [
+                envelope.seq for envelope in batch if envelope.seq is not None
+            ])
+            quitting = any(
+                envelope.message[0] == 'QUIT' for envelope in batch)
+
+            changes = {}
+            # {(server_id, user_id): (User, is_attending)} after the
+            # changes so far, which aren't in the index until committed.
+            states = {}
+            for envelope in batch:
+                message = envelope.message
+                if message[0] in ('ATTENDING', 'NOT_ATTENDING'):
+                    kind, server_id, user = message
+                    is_attending = kind == 'ATTENDING'
+                    key = (server_id, user.user_id)
+                    profiles.pop(key, None)
+                    state = states.get(key) or index.state(*key)
+                    if state == (user, is_attending):
+                        metrics.increment('roster_noop_writes')
+                        continue
+
+                    logging.info('Setting attendance to %s on %s: %s',
+                                 is_attending, server_id, user)
+                    states[key] = (user, is_attending)
+                    changes.setdefault(server_id, []).append(
+                        (user, is_attending))
+                elif message[0] == 'PROFILE':
+                    _, server_id, user = message
+                    profiles[(server_id, user.user_id)] = user
+                elif message[0] == 'REMOVED':
+                    _, server_id, user_id = message
+                    profiles.pop((server_id, user_id), None)
+
+            if changes:
+                start = time.monotonic()
+                for server_id, server_changes in changes.items():
+                    _retry_busy(
+                        metrics,
+                        roster.for_server(server_id).set_users_attendance,
+                        server_changes)
+                    index.set_users_attendance(server_id, server_changes)
+                metrics.observe('roster_commit_seconds',
+                                time.monotonic() - start)
+                metrics.observe(
+                    'roster_batch_size',
+                    sum(map(len, changes.values())),
+                    buckets=_SIZE_BUCKETS)
+
+            spooled = [
+                envelope.seq for envelope in batch if envelope.seq is not None
+            ]
+            if spooled:
+                spool.ack(spooled)
+
+            now = time.time()
+            for envelope in batch:
+                metrics.observe('roster_lag_seconds', now - envelope.time)
+
+            completions = [
+                Completion(envelope.token, envelope.message, envelope.time)
+                for envelope in replayed + batch
+                if envelope.token is not None
+                and envelope.message[0] in DURABLE_KINDS
+            ]
+            for completion in completions:
+                metrics.observe('request_commit_seconds',
+                                now - completion.submitted)
+            if completions and on_commit is not None:
+                on_commit(completions)
+
+            if not profiles:
+                next_flush = None
+            elif next_flush is None:
+                next_flush = time.monotonic() + config.profile_debounce
+
+            if profiles and (quitting or time.monotonic() >= next_flush):
+                _retry_busy(metrics, _flush_profiles, roster, index,
+                            profiles, metrics)
+                profiles = {}
+                next_flush = None
+
+            metrics.set_gauge('roster_queue_depth', messages.qsize())
+            metrics.set_gauge('roster_spool_depth', len(spool))
+            if quitting or time.monotonic() - last_metrics >= METRICS_INTERVAL:
+                metrics.log()
+                last_metrics = time.monotonic()
+
+            if quitting:
+                logging.info('Roster actor is quitting')
+                return
+
+
+def _retry_busy(metrics, write, *args):
+    """Calls write(*args), retrying with backoff while the database is busy."""
+    delay = BUSY_DELAY
+    for attempt in range(BUSY_ATTEMPTS):
+        try:
+            return write(*args)
+        except sqlite3.OperationalError as e:
+            if attempt + 1 == BUSY_ATTEMPTS or not _is_busy(e):
+                raise
+            logging.warning('Roster is busy, retrying in %g seconds: %s',
+                            delay, e)
+            metrics.increment('roster_busy_retries')
+            time.sleep(delay)
+            delay *= 2
+
+
+def _is_busy(e):
+    message = str(e)
+    return 'locked' in message or 'busy' in message
+
+
+def _flush_profiles(roster, index, profiles, metrics):
+    """Writes pending {(server_id, user_id): User} profile updates.
+
+    Profiles that match the index aren't written.
+
+    """
+    by_server = {}
+    for (server_id, user_id), user in profiles.items():
+        if index.profile(server_id, user_id) == user:
+            metrics.increment('roster_noop_writes')
+            continue
+        by_server.setdefault(server_id, []).append(user)
+    if not by_server:
+        return
+
+    start = time.monotonic()
+    for server_id, users in by_server.items():
+        counts = roster.for_server(server_id).update_users(users)
+        index.update_users(server_id, users)
+        metrics.increment('roster_profiles_written',
+                          counts.inserted + counts.updated)
+    metrics.observe('roster_commit_seconds', time.monotonic() - start)
+    metrics.observe(
+        'roster_profile_batch_size', len(profiles), buckets=_SIZE_BUCKETS)
+
+
+def _next_batch(messages, max_size, window, timeout=None):
+    """Takes a batch of messages from the queue.
+
+    Blocks until at least one message is available, then collects further
+    messages until the batch holds max_size messages, window seconds have
+    passed, or a QUIT message arrives.  If no message arrives within
+    timeout seconds, returns an empty batch.
+
+    """
+    try:
+        batch = [messages.get(timeout=timeout)]
+    except Empty:
+        return []
+
+    deadline = time.monotonic() + window
+    while len(batch) < max_size and batch[-1].message[0] != 'QUIT':
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(messages.get(timeout=remaining))
+        except Empty:
+            break
+
+    return batch
@@ -13,77 +13,190 @@
 # limitations under the License.
 #
 import re
+import time
 
 from nametagbot import User
 
-__all__ = ['parse_content']
-
-_ATTENDING_PATTERN = re.compile(
-    '|'.join(
-        map(lambda p: p.format(user=r'([^\s]+)',
-                               nametag=r'(?:a (?:name)?tag|one)'), [
-            '{user} is attending',
-            '{user} will be attending',
-            '{user} will be there',
-            '{user} is going',
-            '{user} wants? {nametag}',
-            '{user} would like {nametag}',
-            'make {user} {nametag}',
-            'make {nametag} for {user}',
-        ])), re.I)
-
-_TARGET_ID_PATTERN = re.compile('<@([^\s]+)>')
+__all__ = ['nametagbot_user', 'parse_content', 'parse_message']
+
+# Intents, and the patterns of messages that express them.  {users} is one
+# or more targets, such as "me" or mentions, separated by commas or "and".
+_INTENTS = [
+    ('NOT_ATTENDING', [
+        '{users} (?:is|are|am) not (?:attending|going|coming)',
+        "{users} (?:isn't|aren't|won't be) (?:attending|going|coming|there)",
+        "{users} (?:doesn't|don't) want {nametag}",
+        'cancel {nametag} for {users}',
+        "cancel {users}(?:'s)? (?:name)?tags?",
+        'remove {users} from the list',
+    ]),
+    ('STATUS', [
+        '(?:is|are|am) {users} (?:attending|going|coming|on the list)',
+        '(?:does|do) {users} have {nametag}',
+    ]),
+    ('ATTENDING', [
+        '{users} (?:is|are|am) attending',
+        '{users} will be attending',
+        '{users} will be there',
+        '{users} (?:is|are|am) going',
+        '{users} wants? {nametag}',
+        '{users} would like {nametag}',
+        'make {users} {nametag}',
+        'make {nametag} for {users}',
+    ]),
+]
+
+# Every pattern contains one of these words, so messages without any of
+# them can be rejected without running the regex.
+_KEYWORDS = ['attend', 'going', 'coming', 'there', 'tag', 'one', 'list']
+
+# Histogram buckets for the time taken to parse a message, in seconds.
+_SECONDS_BUCKETS = [
+    0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01
+]
+
+_TARGET = r'<@!?[^\s>]+>|[^\s,]+'
+_TARGET_SEPARATOR = r'\s*,\s*(?:and\s+)?|\s+and\s+'
+_USERS = '(?:{0})(?:(?:{1})(?:{0}))*'.format(_TARGET, _TARGET_SEPARATOR)
+_NAMETAG = r'(?:(?:an?|the) (?:name)?tag|one|(?:name)?tags)'
+
+
+def _compile_intents(intents):
+    """Compiles intent patterns into a single alternation.
+
+    Each pattern is wrapped in a group named p<n>, and its targets in a
+    group named t<n>.  Patterns only match at the start of a word.
+    Returns the compiled regex and a dict from pattern group names to
+    intents.
+
+    """
+    alternatives = []
+    group_intents = {}
+    for intent, patterns in intents:
+        for pattern in patterns:
+            n = len(alternatives)
+            users = '(?P<t{}>{})'.format(n, _USERS)
+            alternatives.append('(?P<p{}>{})'.format(
+                n, pattern.format(users=users, nametag=_NAMETAG)))
+            group_intents['p{}'.format(n)] = intent
+
+    # Matches can only start at the beginning of a word, which is much
+    # cheaper to check once than at the start of every alternative.
+    return (re.compile(r'(?<!\S)(?:{})'.format('|'.join(alternatives)), re.I),
+            group_intents)
+
+
+_INTENT_PATTERN, _GROUP_INTENTS = _compile_intents(_INTENTS)
+
+_TARGET_SEPARATOR_PATTERN = re.compile(_TARGET_SEPARATOR, re.I)
+
+_TARGET_ID_PATTERN = re.compile(r'<@!?([^\s>]+)>')
 
 
 def parse_content(message_content):
-    match = _ATTENDING_PATTERN.search(message_content)
-    if match is None:
-        return None
-
-    return ('ATTENDING',
-            next(group for group in match.groups() if group is not None))
-
-
-def parse_message(message, server_id, bot_discord_user):
-    if message.server is not None and message.server.id != server_id:
-        return None
+    """Parses a message's text for an intent.
 
-    if not _mentions_discord_user(message, bot_discord_user):
-        return None
+    Returns a tuple of the intent, such as 'ATTENDING', followed by one or
+    more targets, such as 'me' or '<@123>'.  Returns None if the message
+    expresses no intent.
 
-    action = parse_content(message.content)
-    if action[0] != 'ATTENDING':
+    """
+    lowered = message_content.lower()
+    if not any(keyword in lowered for keyword in _KEYWORDS):
         return None
 
-    discord_user = _target_discord_user(message, action[1])
-    if discord_user is None:
+    match = _INTENT_PATTERN.search(message_content)
+    if match is None:
         return None
 
-    return (action[0], _nametagbot_user(discord_user))
-
-
-def _target_discord_user(message, target_name):
-    if target_name.lower() in ('i', 'me'):
+    # The pattern's group closes after its targets' group, so it's the last
+    # group matched.
+    group = match.lastgroup
+    targets = match.group('t' + group[1:])
+    return (_GROUP_INTENTS[group],
+            *_TARGET_SEPARATOR_PATTERN.split(targets))
+
+
+def parse_message(message, server_ids, bot_discord_user, metrics=None):
+    """Parses a chat message addressed to the bot.
+
+    Messages are accepted from the servers in server_ids, or from any
+    server if it's empty.  Direct messages are attributed to the only
+    server in server_ids, and are ignored if there isn't exactly one.
+
+    Returns a list of actions, such as ('ATTENDING', server_id, User(...)),
+    one for each user the message refers to.
+
+    If metrics are given, each message is counted in chat_messages_<outcome>
+    and its parsing time observed in chat_<outcome>_seconds, where outcome
+    is 'accepted' or the reason it was rejected: 'not_addressed',
+    'other_server', 'no_intent' or 'no_target'.
+
+    """
+    start = time.perf_counter()
+    outcome, actions = _parse_message(message, server_ids, bot_discord_user)
+    if metrics is not None:
+        metrics.observe(
+            'chat_{}_seconds'.format(outcome),
+            time.perf_counter() - start,
+            buckets=_SECONDS_BUCKETS)
+        metrics.increment('chat_messages_{}'.format(outcome))
+    return actions
+
+
+def _parse_message(message, server_ids, bot_discord_user):
+    """Returns the outcome of parsing a message, and its actions."""
+    # Most messages aren't addressed to the bot, so they're rejected by
+    # looking for its mention in the raw content, before anything else.
+    content = message.content
+    if ('<@{}>'.format(bot_discord_user.id) not in content
+            and '<@!{}>'.format(bot_discord_user.id) not in content):
+        return 'not_addressed', []
+
+    server = message.server
+    if server is not None:
+        server_id = server.id
+        if server_ids and server_id not in server_ids:
+            return 'other_server', []
+    elif len(server_ids) == 1:
+        server_id, = server_ids
+    else:
+        return 'other_server', []
+
+    action = parse_content(content)
+    if action is None:
+        return 'no_intent', []
+
+    # The bot's own mention is how it's addressed, as in "@nametagbot, I
+    # want a nametag", so it's never a target.
+    mentions = {
+        mention.id: mention
+        for mention in message.mentions if mention.id != bot_discord_user.id
+    }
+    actions = []
+    for target_name in action[1:]:
+        discord_user = _target_discord_user(message, mentions, target_name)
+        if discord_user is not None:
+            actions.append(
+                (action[0], server_id, nametagbot_user(discord_user)))
+    if not actions:
+        return 'no_target', []
+    return 'accepted', actions
+
+
+def _target_discord_user(message, mentions, target_name):
+    if target_name.lower() in ('i', 'me', 'my'):
         return message.author
 
     match = _TARGET_ID_PATTERN.match(target_name)
     if match is None:
         return None
 
-    target_id = match.group(1)
-    for mention in message.mentions:
-        if mention.id == target_id:
-            return mention
-
-
-def _mentions_discord_user(message, discord_user):
-    for mention in message.mentions:
-        if mention == discord_user:
-            return True
-    return False
+    return mentions.get(match.group(1))
 
 
-def _nametagbot_user(discord_user):
+def nametagbot_user(discord_user):
+    """Returns a User for a Discord user, with their nick if they have one."""
     nick = discord_user.name
     if discord_user.nick is not None:
         nick = discord_user.nick
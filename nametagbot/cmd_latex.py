@@ -15,20 +15,49 @@
 """Output LaTeX for discord nametags.
 
 This command generates LaTeX source for printed nametags for users in
-nametagbot's roster.
+nametagbot's roster.  Nametags are output for one server at a time, which
+must be given with --server unless exactly one server is configured.
+
+For large rosters, the nametags can be split into several shards of whole
+pages, each in its own .tex file.  With --compile, the shards are compiled
+in parallel and their PDFs concatenated into nametags.pdf, which requires
+pdfunite from poppler-utils.
+
+With --incremental, an existing output directory is updated, and only
+avatars and shards that changed since the last build are rewritten and
+recompiled.
+
+Templates in --template-dir, or the configuration's TemplateDir, override
+the built-in nametags.tex.  Compiled templates are cached in the cache
+directory.
 
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
 import itertools
 import jinja2
+import json
 import logging
+import math
 import os
+import subprocess
 
 from .config import Config
+from .data import (AVATAR_SIZES, AvatarFormat, DEFAULT_POOL_SIZE,
+                   MATERIALIZE_METHODS, UserColumns)
 
 BOX_X_COORDINATES = [0.69, 4.44]
 BOX_Y_COORDINATES = [0.56, 3.08, 5.6, 8.13]
+BOXES_PER_PAGE = len(BOX_X_COORDINATES) * len(BOX_Y_COORDINATES)
+
+# Name of the file in an output directory that records what was built.
+MANIFEST_NAME = 'manifest.json'
+
+# Printed width and height of avatars in the template.
+AVATAR_INCHES = 1
 
 
 def main():
@@ -38,56 +67,431 @@ def main():
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter)
     p.add_argument('-c', '--config', type=str, help='configuration file path')
+    p.add_argument(
+        '-s', '--server', type=str, help='ID of the server to output')
     p.add_argument(
         '-a',
         '--all',
         action='store_true',
         help='include all users, not only the ones marked attending')
+    p.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=DEFAULT_POOL_SIZE,
+        help='number of avatars to download concurrently')
+    p.add_argument(
+        '--revalidate',
+        action='store_true',
+        help='check cached avatars with the CDN for changes')
+    p.add_argument(
+        '--link',
+        choices=MATERIALIZE_METHODS,
+        default='auto',
+        help='how to place cached avatars in the output directory')
+    p.add_argument(
+        '--avatar-size',
+        type=int,
+        choices=AVATAR_SIZES,
+        help='size in pixels of avatars to download from Discord')
+    p.add_argument(
+        '--avatar-dpi',
+        type=int,
+        help='downscale avatars to this print resolution (requires Pillow)')
+    p.add_argument(
+        '--circle',
+        action='store_true',
+        help='pre-clip downscaled avatars to a circle (requires --avatar-dpi)')
+    p.add_argument(
+        '--shards',
+        type=int,
+        default=1,
+        help='number of .tex files to split the nametags into')
+    p.add_argument(
+        '--incremental',
+        action='store_true',
+        help='update an existing output directory with changes only')
+    p.add_argument(
+        '--compile',
+        action='store_true',
+        help='compile the nametags into nametags.pdf')
+    p.add_argument(
+        '--latex-engine',
+        default='lualatex',
+        help='LaTeX engine used by --compile (default: %(default)s)')
+    p.add_argument(
+        '--compile-jobs',
+        type=int,
+        default=os.cpu_count(),
+        help='number of shards to compile concurrently')
+    p.add_argument(
+        '--template-dir',
+        type=str,
+        help='directory of templates that override the built-in ones')
     p.add_argument('output_dir', type=str, help='output directory path')
     args = p.parse_args()
+    if args.shards < 1:
+        p.error('--shards must be at least 1')
+    if args.circle and args.avatar_dpi is None:
+        p.error('--circle requires --avatar-dpi')
 
     config = Config(args.config)
-    _write_latex(config, args.output_dir)
+    server_id = args.server
+    if server_id is None:
+        if len(config.server_ids) != 1:
+            p.error('--server is required unless one server is configured')
+        server_id = config.server_ids[0]
+
+    avatar_format = _avatar_format(args.avatar_dpi, args.circle)
+    avatar_size = _avatar_size(args.avatar_size, config.avatar_size,
+                               avatar_format)
+
+    tex_names = _write_latex(
+        config,
+        args.output_dir,
+        jobs=args.jobs,
+        revalidate=args.revalidate,
+        link=args.link,
+        avatar_size=avatar_size,
+        avatar_format=avatar_format,
+        shards=args.shards,
+        incremental=args.incremental,
+        all_users=args.all,
+        server_id=server_id,
+        template_dir=args.template_dir)
+
+    if args.compile:
+        _compile_pdf(args.output_dir, tex_names, args.latex_engine,
+                     args.compile_jobs)
+
+
+@functools.lru_cache()
+def _latex_jinja_env(template_dir, bytecode_dir):
+    """Returns the Jinja environment for LaTeX templates.
+
+    Templates in template_dir, if it's given, override the package's own.
+    Compiled templates are cached in bytecode_dir, so they're only compiled
+    again when their source changes.
+
+    """
+    loader = jinja2.PackageLoader('nametagbot', 'templates')
+    if template_dir is not None:
+        loader = jinja2.ChoiceLoader(
+            [jinja2.FileSystemLoader(template_dir), loader])
+    os.makedirs(bytecode_dir, 0o750, exist_ok=True)
+
+    # http://eosrei.net/articles/2015/11/latex-templates-python-and-jinja2-generate-pdfs
+    return jinja2.Environment(
+        block_start_string=r'\BLOCK{',
+        block_end_string='}',
+        variable_start_string=r'\VAR{',
+        variable_end_string='}',
+        comment_start_string=r'\#{',
+        comment_end_string='}',
+        line_statement_prefix='%%',
+        line_comment_prefix='%#',
+        trim_blocks=True,
+        autoescape=False,
+        loader=loader,
+        bytecode_cache=jinja2.FileSystemBytecodeCache(bytecode_dir))
+
+
+def _box_coordinates():
+    return itertools.cycle(
+        map(lambda c: tuple(reversed(c)),
+            itertools.product(BOX_Y_COORDINATES, BOX_X_COORDINATES)))
+
+
+def _write_latex(config,
+                 output_dir,
+                 jobs=DEFAULT_POOL_SIZE,
+                 revalidate=False,
+                 link='auto',
+                 avatar_size=None,
+                 avatar_format=None,
+                 shards=1,
+                 incremental=False,
+                 all_users=False,
+                 server_id=None,
+                 template_dir=None):
+    """Writes LaTeX source and avatars to output_dir.
+
+    In incremental mode, an existing output directory is updated in place:
+    avatars are only replaced if they changed, and .tex files are only
+    rewritten (and their PDFs removed) if any of their pages changed since
+    the build recorded in the directory's manifest.
+
+    Nametags are written for the users of the given server, by default the
+    configured one.  Templates in template_dir, by default the configured
+    TemplateDir, override the built-in ones.  Returns the names of the .tex
+    files for the nametags.
+
+    """
+    roster = config.get_roster(server_id)
+    avatar_cache = config.get_avatar_cache(
+        revalidate=revalidate, size=avatar_size)
+
+    # Avatars are only evicted from the cache once the build is done, and
+    # never the ones it used.
+    with avatar_cache.batch():
+        # Held column by column, so large rosters stay small in memory.
+        users = roster.export_columns(attending=None if all_users else True)
+
+        logging.info('Prefetching avatars for %d users', len(users))
+        users = _prefetch_avatars(avatar_cache, users, jobs, avatar_format)
+
+        env = _latex_jinja_env(template_dir or config.template_path,
+                               os.path.join(config.cache_path, 'templates'))
+        template = env.get_template('nametags.tex')
+        options = {
+            'avatar_size': avatar_size,
+            'avatar_format': avatar_format,
+            'shards': shards,
+            'template': _template_digest(template),
+        }
+
+        manifest = None
+        if incremental:
+            os.makedirs(os.path.join(output_dir, 'avatars'), exist_ok=True)
+            manifest = _read_manifest(output_dir)
+        else:
+            os.mkdir(output_dir)
+            os.mkdir(os.path.join(output_dir, 'avatars'))
+
+        if manifest is None:
+            manifest = {'options': None, 'users': [], 'shards': {}}
+
+        # Files built with other options are still cleaned up, but none of
+        # them are reused.
+        previous_digests = {
+            entry['user_id']: entry['avatar_sha256']
+            for entry in manifest['users']
+        }
+        previous_shards = manifest['shards']
+        if manifest['options'] != _json_value(options):
+            previous_digests = dict.fromkeys(previous_digests)
+            previous_shards = dict.fromkeys(previous_shards)
 
+        entries = []
+        for i, user in enumerate(users):
+            digest = avatar_cache.avatar_digest(user, avatar_format)
+            avatar_path = _avatar_path(output_dir, user.user_id)
+            if (previous_digests.get(user.user_id) != digest
+                    or not os.path.exists(avatar_path)):
+                avatar_cache.get_avatar(
+                    user,
+                    avatar_path,
+                    method=link,
+                    avatar_format=avatar_format)
 
-# http://eosrei.net/articles/2015/11/latex-templates-python-and-jinja2-generate-pdfs
-_latex_jinja_env = jinja2.Environment(
-    block_start_string='\BLOCK{',
-    block_end_string='}',
-    variable_start_string='\VAR{',
-    variable_end_string='}',
-    comment_start_string='\#{',
-    comment_end_string='}',
-    line_statement_prefix='%%',
-    line_comment_prefix='%#',
-    trim_blocks=True,
-    autoescape=False,
-    loader=jinja2.PackageLoader('nametagbot', 'templates'))
+            entries.append({
+                'user_id': user.user_id,
+                'nick': user.nick,
+                'avatar_sha256': digest,
+                'page': i // BOXES_PER_PAGE,
+                'box': i % BOXES_PER_PAGE,
+            })
 
-_box_coordinates = itertools.cycle(
-    map(lambda c: tuple(reversed(c)),
-        itertools.product(BOX_Y_COORDINATES, BOX_X_COORDINATES)))
+        current = set(e['user_id'] for e in entries)
+        for user_id in set(previous_digests) - current:
+            _remove_if_exists(_avatar_path(output_dir, user_id))
 
+        shard_digests = {}
+        offset = 0
+        for i, shard_users in enumerate(_shard_users(users, shards)):
+            tex_name = 'nametags-{:03}.tex'.format(i)
+            if shards == 1:
+                tex_name = 'nametags.tex'
 
-def _write_latex(config, output_dir):
-    roster = config.get_roster()
-    avatar_cache = config.get_avatar_cache()
+            shard_entries = entries[offset:offset + len(shard_users)]
+            offset += len(shard_users)
+            digest = hashlib.sha256(
+                json.dumps(shard_entries, sort_keys=True).encode()).hexdigest()
+            shard_digests[tex_name] = digest
 
-    # TODO(mshroyer): Honor 'all' parameter.
-    users = list(roster.attending_users())
+            tex_path = os.path.join(output_dir, tex_name)
+            if (previous_shards.get(tex_name) == digest
+                    and os.path.exists(tex_path)):
+                logging.debug('%s is unchanged', tex_name)
+                continue
 
-    os.mkdir(output_dir)
-    os.mkdir(os.path.join(output_dir, 'avatars'))
+            logging.info('Writing %s', tex_name)
+            _remove_if_exists(_pdf_name(tex_path))
+            template.stream(
+                users=zip(shard_users, _box_coordinates()),
+                escape=_latex_escape).dump(tex_path)
+
+        for tex_name in set(previous_shards) - set(shard_digests):
+            tex_path = os.path.join(output_dir, tex_name)
+            _remove_if_exists(tex_path)
+            _remove_if_exists(_pdf_name(tex_path))
+
+        _write_manifest(output_dir, {
+            'options': _json_value(options),
+            'users': entries,
+            'shards': shard_digests,
+        })
+
+        return sorted(shard_digests)
+
+
+def _prefetch_avatars(avatar_cache, users, jobs, avatar_format):
+    """Caches the users' avatars, and returns the users to write.
+
+    Users whose avatars can't be fetched are given the default avatar, and
+    are left out if that can't be fetched either, so that writing the
+    nametags never fetches an avatar again.
+
+    """
+    failed = _prefetch_failures(avatar_cache, users, jobs, avatar_format)
+    if not failed:
+        return users
+
+    # Users who already had the default avatar have nothing to fall back to.
+    missing = {
+        user_id: user
+        for user_id, user in failed.items() if not user.avatar
+    }
+    defaults = [
+        user._replace(avatar='') for user in failed.values() if user.avatar
+    ]
+    missing.update(
+        _prefetch_failures(avatar_cache, defaults, jobs, avatar_format))
+
+    written = UserColumns()
     for user in users:
-        avatar_cache.get_avatar(
-            user,
-            os.path.join(output_dir, 'avatars',
-                         '{user_id}.png'.format(**user._asdict())))
-
-    template = _latex_jinja_env.get_template('nametags.tex')
-    template.stream(
-        users=zip(users, _box_coordinates), escape=_latex_escape).dump(
-            os.path.join(output_dir, 'nametags.tex'))
+        if user.user_id in missing:
+            logging.warning('Leaving out %s, who has no avatar', user)
+            continue
+        if user.user_id in failed:
+            user = user._replace(avatar='')
+        written.append(*user)
+    return written
+
+
+def _prefetch_failures(avatar_cache, users, jobs, avatar_format):
+    """Caches the users' avatars, and returns {user_id: User} failures."""
+    failed = {}
+    for user, e in avatar_cache.prefetch(
+            users, max_workers=jobs, avatar_format=avatar_format):
+        logging.warning('Error prefetching avatar for %s: %s', user, e)
+        failed[user.user_id] = user
+    return failed
+
+
+def _template_digest(template):
+    env = template.environment
+    source = env.loader.get_source(env, template.name)[0]
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def _avatar_path(output_dir, user_id):
+    return os.path.join(output_dir, 'avatars', '{}.png'.format(user_id))
+
+
+def _pdf_name(tex_name):
+    return os.path.splitext(tex_name)[0] + '.pdf'
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _json_value(value):
+    """Converts tuples in a JSON-serializable value to lists."""
+    return json.loads(json.dumps(value))
+
+
+def _read_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def _shard_users(users, shards):
+    """Splits users into at most the given number of shards of whole pages."""
+    pages = max(1, math.ceil(len(users) / BOXES_PER_PAGE))
+    shard_size = math.ceil(pages / shards) * BOXES_PER_PAGE
+    return [
+        users[i:i + shard_size]
+        for i in range(0, max(1, len(users)), shard_size)
+    ]
+
+
+def _compile_pdf(output_dir, tex_names, engine, jobs):
+    """Compiles .tex files concurrently, and concatenates their PDFs.
+
+    Only .tex files without an existing PDF are compiled.
+
+    """
+
+    def compile_tex(tex_name):
+        logging.info('Compiling %s', tex_name)
+        subprocess.run(
+            [engine, '-interaction=batchmode', '-halt-on-error', tex_name],
+            cwd=output_dir,
+            stdout=subprocess.DEVNULL,
+            check=True)
+
+    stale = [
+        tex_name for tex_name in tex_names
+        if not os.path.exists(os.path.join(output_dir, _pdf_name(tex_name)))
+    ]
+
+    # Each compilation runs in its own engine process, so threads are
+    # enough to keep every core busy.
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(compile_tex, stale))
+
+    pdf_names = [_pdf_name(tex_name) for tex_name in tex_names]
+    if len(pdf_names) > 1:
+        logging.info('Concatenating %d PDFs', len(pdf_names))
+        subprocess.run(
+            ['pdfunite'] + pdf_names + ['nametags.pdf'],
+            cwd=output_dir,
+            check=True)
+
+
+def _avatar_format(dpi, circle):
+    if dpi is None:
+        return None
+    return AvatarFormat(int(AVATAR_INCHES * dpi), circle)
+
+
+def _avatar_size(requested, configured, avatar_format):
+    """Returns the size of avatars to download, or None for the default.
+
+    The requested size wins, then the configured one, which the bot also
+    uses to cache avatars ahead of time.  Only if neither is given is the
+    size chosen to suit avatar_format.
+
+    """
+    for size in [requested, configured]:
+        if size is not None:
+            return size
+    if avatar_format is not None:
+        return _download_size(avatar_format.pixels)
+    return None
+
+
+def _download_size(pixels):
+    """Returns the smallest CDN avatar size of at least the given pixels."""
+    for size in AVATAR_SIZES:
+        if size >= pixels:
+            return size
+    return AVATAR_SIZES[-1]
 
 
 def _latex_escape(s):
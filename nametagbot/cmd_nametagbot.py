@@ -12,18 +12,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-"""Connects to a server.
+"""Connects to Discord and serves nametag requests.
+
+The bot serves the servers listed in the configuration's ServerIds, or all
+servers it has joined if none are listed.  Changes to the servers' members
+are written to the roster as they happen.  Requests are acknowledged with a
+reaction once they've been committed to the roster, or with a summary reply
+when many arrive at once.
 
 """
 
 import argparse
+import asyncio
 import discord
 import logging
-from queue import Queue
-import sys
-from threading import Thread
 
+from .ack import Acknowledger
+from .actor import RosterActor
 from .config import Config
+from .metrics import Metrics
 from . import chat
 
 
@@ -41,63 +48,115 @@ def main():
 
 
 def _run_bot(config):
-    roster_messages = Queue()
-    roster_thread = Thread(
-        target=_roster_actor, args=(config, roster_messages))
-    roster_thread.start()
-
+    metrics = Metrics()
     client = discord.Client()
 
-    @client.event
-    async def on_ready():
-        logging.info('Connected to server %s', config.server_id)
+    async def react(message):
+        await client.add_reaction(message, '\N{WHITE HEAVY CHECK MARK}')
 
-        bot_member = client.get_server(config.server_id).me
-        logging.info('Roles: %s',
-                     list(map(lambda role: role.name, bot_member.roles)))
-        perms = bot_member.server_permissions
-        logging.info('Permission to read messages: %s', perms.read_messages)
+    async def reply(channel, text):
+        await client.send_message(channel, text)
 
-    @client.event
-    async def on_message(message):
-        action = chat.parse_message(message, config.server_id, client.user)
-        if action is None:
-            return
+    # The actor reports committed requests back to the event loop, where
+    # they're acknowledged in chat.
+    acknowledger = Acknowledger(client.loop, react, reply, metrics)
+    client.loop.create_task(acknowledger.run())
 
-        logging.info('Action: %s', action)
-        roster_messages.put(action)
+    avatar_cache = config.get_async_avatar_cache()
+    roster = config.get_roster()
+    spool = config.get_spool()
+    actor = RosterActor(
+        config, metrics, spool, on_commit=acknowledger.complete)
 
-    client.run(config.bot_token)
+    async def warm_avatar(user):
+        try:
+            await avatar_cache.cache_avatar(user)
+        except Exception as e:
+            logging.warning('Error caching avatar for %s: %s', user, e)
 
-    roster_messages.put(('QUIT', ))
-    roster_thread.join()
+    # A set, so every message's server can be checked cheaply.
+    server_ids = frozenset(config.server_ids)
 
+    def serves(server):
+        return server is not None and (not server_ids
+                                       or server.id in server_ids)
 
-def _roster_actor(config, messages):
-    """Act on messages for the roster.
+    @client.event
+    async def on_ready():
+        for server in client.servers:
+            if not serves(server):
+                continue
+
+            logging.info('Connected to server %s', server.id)
+            bot_member = server.me
+            logging.info('Roles: %s',
+                         list(map(lambda role: role.name, bot_member.roles)))
+            perms = bot_member.server_permissions
+            logging.info('Permission to read messages: %s',
+                         perms.read_messages)
+
+    async def reply_status(message, server_id, user):
+        # The actor's index answers without touching the database once it's
+        # loaded.  Until then, queries run on the roster's pool of reader
+        # connections, so they can be made from the executor's threads.
+        if actor.index.loaded.is_set():
+            is_attending = actor.index.is_attending(server_id, user.user_id)
+        else:
+            is_attending = await client.loop.run_in_executor(
+                None,
+                roster.for_server(server_id).is_attending, user.user_id)
+        await client.send_message(
+            message.channel, '{} is {}on the list for a nametag.'.format(
+                user.nick, '' if is_attending else 'not '))
 
-    The Roster class is not thread-safe, so we use a single actor thread to
-    serialize messages for the database.  Messages can be:
+    @client.event
+    async def on_message(message):
+        for action in chat.parse_message(message, server_ids, client.user,
+                                         metrics):
+            logging.info('Action: %s', action)
+            if action[0] == 'STATUS':
+                await reply_status(message, action[1], action[2])
+                continue
+
+            actor.submit(action, token=message)
+            if action[0] == 'ATTENDING':
+                # Fetch the avatar in the background, so it's already
+                # cached by the time nametags are printed.
+                asyncio.ensure_future(warm_avatar(action[2]))
 
-    ('QUIT')
-    ('ATTENDING', User(...))
+    @client.event
+    async def on_member_join(member):
+        if serves(member.server):
+            actor.submit(('PROFILE', member.server.id,
+                          chat.nametagbot_user(member)))
 
-    """
-    logging.info('Roster actor is starting')
+    @client.event
+    async def on_member_update(before, after):
+        user = chat.nametagbot_user(after)
+        if serves(after.server) and chat.nametagbot_user(before) != user:
+            actor.submit(('PROFILE', after.server.id, user))
 
+    @client.event
+    async def on_member_remove(member):
+        if serves(member.server):
+            actor.submit(('REMOVED', member.server.id, member.id))
+
+    try:
+        actor.start()
+        client.run(config.bot_token)
+    finally:
+        actor.stop()
+        roster.close()
+        spool.close()
+        _close_avatar_cache(avatar_cache)
+
+
+def _close_avatar_cache(avatar_cache):
+    """Closes the avatar cache once the client has closed its event loop."""
+    loop = asyncio.new_event_loop()
     try:
-        with config.get_roster() as roster:
-            while True:
-                message = messages.get()
-
-                if message[0] == 'QUIT':
-                    logging.info('Roster actor is quitting')
-                    return
-
-                if message[0] == 'ATTENDING':
-                    user = message[1]
-                    logging.info('Setting attendance to True: %s', user)
-                    roster.set_user_attendance(user, True)
+        loop.run_until_complete(avatar_cache.close())
     except Exception as e:
-        logging.critical('Roster actor failed: %s', e)
-        sys._exit(1)
+        logging.warning('Error closing avatar cache: %s', e)
+    finally:
+        loop.close()
@@ -15,12 +15,21 @@
 """Update nametagbot's roster from Discord.
 
 This command updates nametagbot's roster from the server(s). Updated nicks
-and avatar IDs are retrieved for all users. Records of user attendance are
-not altered by this command.
+and avatar IDs are retrieved for all users.  While it's running, the bot
+keeps the roster up to date as members change, so this only needs to be
+run occasionally, to reconcile changes made while the bot was offline.
+Records of user attendance are not altered by this command.  Afterwards,
+cached avatars that no longer belong to any user in the roster are
+removed.
+
+Users are written to the roster in chunks while the server's members are
+being read, so the update's memory use doesn't grow with the server's
+size, and an interrupted update keeps the chunks it already wrote.
 
 One or more servers may optionally be specified, in which case users will
 only be updated from those servers. By default, the command will update
-users from all servers the bot has joined.
+users from the servers listed in the configuration's ServerIds, or from all
+servers the bot has joined if none are listed.
 
 """
 
@@ -28,8 +37,9 @@ import argparse
 import discord
 import logging
 
-from . import User
+from .chat import nametagbot_user
 from .config import Config
+from .data import DEFAULT_SYNC_CHUNK_SIZE
 
 
 def main():
@@ -39,50 +49,79 @@ def main():
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter)
     p.add_argument('-c', '--config', type=str, help='configuration file path')
+    p.add_argument(
+        '--chunk-size',
+        type=int,
+        default=DEFAULT_SYNC_CHUNK_SIZE,
+        help='number of users to write per transaction')
+    p.add_argument(
+        'servers', type=str, nargs='*', help='IDs of servers to update')
     args = p.parse_args()
+    if args.chunk_size < 1:
+        p.error('--chunk-size must be at least 1')
 
     config = Config(args.config)
-    _update_roster(config)
+    _update_roster(config, args.servers or config.server_ids, args.chunk_size)
 
 
-def _update_roster(config):
+def _update_roster(config, server_ids, chunk_size=DEFAULT_SYNC_CHUNK_SIZE):
     client = discord.Client()
-    users = []
     errors = []
 
-    def retrieve_users():
-        nonlocal users
-
-        logging.info('Retrieving users from server %s', config.server_id)
-        for member in client.get_server(config.server_id).members:
-            nick = member.nick if member.nick is not None else member.name
-            users.append(
-                User(member.id, nick, member.discriminator, member.avatar))
-
-    @client.event
-    async def on_ready():
-        nonlocal errors
-
-        logging.info('Ready!')
-        try:
-            retrieve_users()
-        except Exception as e:
-            logging.error('Error retrieving users: %s', e)
+    def sync_users(roster):
+        synced = set()
+        for server in client.servers:
+            if server_ids and server.id not in server_ids:
+                continue
+
+            server_roster = roster.for_server(server.id)
+            logging.info('Updating roster of server %s with %d users',
+                         server.id, server.member_count)
+            counts = server_roster.sync_users(
+                _member_users(server), chunk_size=chunk_size)
+            logging.info(
+                'Inserted %d, updated %d and left %d users unchanged',
+                *counts)
+            synced.add(server.id)
+
+        for server_id in set(server_ids) - synced:
+            logging.warning('Not a member of server %s', server_id)
+
+    # A roster from before servers were partitioned is assigned to the
+    # server being updated, if there's only one.
+    roster_server_id = server_ids[0] if len(server_ids) == 1 else None
+    with config.get_roster(roster_server_id) as roster:
+
+        @client.event
+        async def on_ready():
+            nonlocal errors
+
+            logging.info('Ready!')
+            try:
+                sync_users(roster)
+            except Exception as e:
+                logging.error('Error updating users: %s', e)
+
+                # discord.py's event system would otherwise eat an
+                # exception, so we need to manually propagate it outside
+                # the event loop in order to stop the script.
+                errors.append(e)
+            finally:
+                logging.info('Logging out')
+                await client.logout()
+
+        client.run(config.bot_token)
+
+        for e in errors:
+            raise Exception('Error in event loop') from e
+
+        with config.get_avatar_cache() as avatar_cache:
+            avatar_cache.sweep_orphans(roster)
 
-            # discord.py's event system would otherwise eat an exception,
-            # so we need to manually propagate it outside the event loop in
-            # order to stop the script.
-            errors.append(e)
-        finally:
-            logging.info('Logging out')
-            await client.logout()
-
-    client.run(config.bot_token)
-
-    for e in errors:
-        raise Exception('Error in event loop') from e
+    logging.info('Done!')
 
-    logging.info('Updating roster with %d users', len(users))
-    config.get_roster().update_users(users)
 
-    logging.info('Done!')
+def _member_users(server):
+    """Yields a server's members as Users, without copying the member list."""
+    for member in server.members:
+        yield nametagbot_user(member)
@@ -17,7 +17,9 @@ import configparser
 import os
 import os.path
 
-from .data import AvatarCache, Roster
+from .data import (AsyncAvatarCache, AvatarCache, DEFAULT_MAX_AVATAR_BYTES,
+                   DEFAULT_READERS, Roster)
+from .spool import Spool
 
 APPNAME = 'nametagbot'
 
@@ -38,11 +40,24 @@ class Config:
 
         self.c = configparser.ConfigParser()
         self.c.add_section('files')
+        self.c.add_section('bot')
+        self.c.add_section('database')
         self.c.read(path)
 
     @property
-    def server_id(self):
-        return self._get_required('connection', 'ServerId')
+    def server_ids(self):
+        """IDs of the servers the bot serves.
+
+        These are read from ServerIds, a list separated by commas or
+        whitespace, or from the single ServerId of older configurations.
+        An empty list means all servers the bot has joined.
+
+        """
+        value = self.c.get(
+            'connection',
+            'ServerIds',
+            fallback=self.c.get('connection', 'ServerId', fallback=''))
+        return value.replace(',', ' ').split()
 
     @property
     def bot_token(self):
@@ -56,11 +71,99 @@ class Config:
     def cache_path(self):
         return self.c['files'].get('CacheDir', appdirs.user_cache_dir(APPNAME))
 
-    def get_roster(self):
-        return Roster(os.path.join(self.data_path, 'roster.db'))
+    @property
+    def template_path(self):
+        return self.c['files'].get('TemplateDir')
+
+    @property
+    def max_cache_bytes(self):
+        return self.c['files'].getint('MaxCacheBytes')
+
+    @property
+    def max_cache_entries(self):
+        return self.c['files'].getint('MaxCacheEntries')
+
+    @property
+    def max_avatar_bytes(self):
+        return self.c['files'].getint(
+            'MaxAvatarBytes', fallback=DEFAULT_MAX_AVATAR_BYTES)
+
+    @property
+    def avatar_size(self):
+        return self.c['files'].getint('AvatarSize')
+
+    @property
+    def roster_batch_size(self):
+        return self.c['bot'].getint('RosterBatchSize', fallback=100)
+
+    @property
+    def roster_batch_window(self):
+        return self.c['bot'].getfloat('RosterBatchWindow', fallback=0.05)
+
+    @property
+    def roster_queue_size(self):
+        return self.c['bot'].getint('RosterQueueSize', fallback=10000)
 
-    def get_avatar_cache(self):
-        return AvatarCache(os.path.join(self.cache_path, 'avatars'))
+    @property
+    def profile_debounce(self):
+        return self.c['bot'].getfloat('ProfileDebounce', fallback=5)
+
+    @property
+    def compaction_interval(self):
+        return self.c['database'].getfloat(
+            'CompactionInterval', fallback=24 * 60 * 60)
+
+    @property
+    def history_retention(self):
+        return self.c['database'].getfloat(
+            'HistoryRetention', fallback=30 * 24 * 60 * 60)
+
+    def get_roster(self, server_id=None):
+        """Returns the roster, scoped to the given server.
+
+        By default, the roster is scoped to the configured server if exactly
+        one is configured.  A roster from before servers were partitioned
+        can only be opened for a server, which its users are assigned to.
+
+        """
+        if server_id is None:
+            server_ids = self.server_ids
+            server_id = server_ids[0] if len(server_ids) == 1 else ''
+
+        database = self.c['database']
+        return Roster(
+            os.path.join(self.data_path, 'roster.db'),
+            server_id=server_id,
+            journal_mode=database.get('JournalMode', 'wal'),
+            synchronous=database.get('Synchronous', 'normal'),
+            cache_size=database.getint('CacheSize'),
+            mmap_size=database.getint('MmapSize'),
+            busy_timeout=database.getint('BusyTimeout', fallback=5000),
+            readers=database.getint('Readers', fallback=DEFAULT_READERS))
+
+    def get_spool(self):
+        return Spool(os.path.join(self.data_path, 'spool.db'))
+
+    def get_avatar_cache(self, revalidate=False, size=None):
+        return AvatarCache(
+            self._avatar_cache_path(),
+            revalidate=revalidate,
+            size=size if size is not None else self.avatar_size,
+            max_bytes=self.max_cache_bytes,
+            max_entries=self.max_cache_entries,
+            max_avatar_bytes=self.max_avatar_bytes)
+
+    def get_async_avatar_cache(self, revalidate=False, size=None):
+        return AsyncAvatarCache(
+            self._avatar_cache_path(),
+            revalidate=revalidate,
+            size=size if size is not None else self.avatar_size,
+            max_bytes=self.max_cache_bytes,
+            max_entries=self.max_cache_entries,
+            max_avatar_bytes=self.max_avatar_bytes)
+
+    def _avatar_cache_path(self):
+        return os.path.join(self.cache_path, 'avatars')
 
     @staticmethod
     def _default_config_path():
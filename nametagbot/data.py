@@ -12,101 +12,874 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import aiohttp
+from array import array
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import copy
+import errno
+import hashlib
+import inspect
+import io
+import itertools
 import logging
 import os
+import queue
+import re
 import requests
+import requests.adapters
 import shutil
 import sqlite3
+import string
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
 
 from nametagbot import User
 
-__all__ = ['AvatarCache', 'Roster']
+try:
+    from PIL import Image, ImageChops, ImageDraw, ImageOps
+except ImportError:
+    Image = None
+
+__all__ = [
+    'AsyncAvatarCache', 'AvatarCache', 'AvatarFormat', 'Roster',
+    'SyncProgress', 'UpdateCounts', 'UserColumns', 'UserPage'
+]
 
 CDN_PREFIX = 'https://cdn.discordapp.com/'
 
+# Default number of concurrent avatar downloads, and of pooled connections
+# to the CDN.
+DEFAULT_POOL_SIZE = 8
+
+# Ways of materializing a cached avatar at an output path.  'auto' uses the
+# cheapest of reflink, hardlink and copy that the filesystem supports.
+MATERIALIZE_METHODS = ['auto', 'copy', 'hardlink', 'reflink', 'symlink']
+
+# Largest avatar response that will be accepted by default.
+DEFAULT_MAX_AVATAR_BYTES = 8 * 1024 * 1024
+
+# Size of the chunks in which avatars are streamed to disk.
+_CHUNK_SIZE = 64 * 1024
+
+# Age after which a temporary download file is assumed to be abandoned.
+_STALE_TMP_SECONDS = 60 * 60
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Default number of read-only connections to a roster database.
+DEFAULT_READERS = 4
+
+_JOURNAL_MODES = ['delete', 'truncate', 'persist', 'memory', 'wal', 'off']
+_SYNCHRONOUS = ['off', 'normal', 'full', 'extra']
+
+# Avatar sizes, in pixels, that the CDN can serve.
+AVATAR_SIZES = [2**n for n in range(4, 13)]
+
+# Normalized avatar variant of a cached avatar: a square image with the
+# given width and height in pixels, optionally clipped to a circle.
+AvatarFormat = namedtuple('AvatarFormat', ['pixels', 'circle'])
+
+# Linux ioctl to share a file's extents with another file (a reflink).
+_FICLONE = 0x40049409
+
+
+# Default number of users in a page of query results.
+DEFAULT_PAGE_SIZE = 500
+
+# A page of users, and the key to pass to Roster.query_users to get the next
+# page or None if this is the last.
+UserPage = namedtuple('UserPage', ['users', 'next_key'])
+
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+# Decimal user IDs without leading zeros, which UserColumns packs as ints.
+_CANONICAL_ID_PATTERN = re.compile(r'0|[1-9][0-9]*')
+
+# Numbers of users inserted, updated and left unchanged by an update.
+UpdateCounts = namedtuple('UpdateCounts', ['inserted', 'updated', 'unchanged'])
+
+# Number of users written per transaction by Roster.sync_users.
+DEFAULT_SYNC_CHUNK_SIZE = 1000
+
+# When an unfinished sync of a server's users started, and how many users
+# it had written.
+SyncProgress = namedtuple('SyncProgress', ['started', 'users'])
+
 
 class Roster:
     """Roster database interface.
 
-    Not threadsafe.
+    Writes go through a single connection and are not threadsafe.  Queries
+    run on a pool of read-only connections, so they may be made from any
+    thread, and with the default WAL journal mode they don't block (and
+    aren't blocked by) writers, including those in other processes.
+
+    A roster holds the users of any number of Discord servers, partitioned
+    by server ID.  Reads and writes apply to the server_id given to the
+    constructor; for_server returns a view of the same database for
+    another server.  Rosters created before servers were partitioned have
+    their users assigned to server_id when they're first opened, and
+    raise ValueError if it's empty.
+
+    Every change to a user's profile or attendance is appended to an event
+    log, and the User and Attendance tables are maintained as a view of the
+    log's current state.  Periodic snapshots of that state allow the log to
+    be compacted, and answer point-in-time queries such as
+    attending_users_at.
+
+    The remaining keyword arguments tune the SQLite pragmas of the same
+    names; None leaves SQLite's default.
 
     """
 
-    def __init__(self, db_path, init_db=True):
+    def __init__(self,
+                 db_path,
+                 init_db=True,
+                 clock=time.time,
+                 server_id='',
+                 journal_mode='wal',
+                 synchronous='normal',
+                 cache_size=None,
+                 mmap_size=None,
+                 busy_timeout=5000,
+                 readers=DEFAULT_READERS):
         _makedirs_for_data_file(db_path)
+        self.clock = clock
+        self.server_id = server_id
+        # busy_timeout goes first, so the pragmas that follow wait for a
+        # lock held by another connection instead of failing with SQLITE_BUSY.
+        self.pragmas = [
+            ('busy_timeout', _pragma_int(busy_timeout)),
+            ('journal_mode', _pragma_keyword(journal_mode, _JOURNAL_MODES)),
+            ('synchronous', _pragma_keyword(synchronous, _SYNCHRONOUS)),
+            ('cache_size', _pragma_int(cache_size)),
+            ('mmap_size', _pragma_int(mmap_size)),
+        ]
+
         self.db = sqlite3.connect(
             db_path,
             isolation_level=None,  # Explicit transaction handling.
             check_same_thread=True)
+        self._configure(self.db)
         if init_db:
-            self._init_db()
+            try:
+                self._init_db()
+            except Exception:
+                self.db.close()
+                raise
+
+        if db_path == ':memory:':
+            self._readers = None
+        else:
+            self._readers = _ConnectionPool(
+                lambda: self._connect_reader(db_path), readers)
+
+    def for_server(self, server_id):
+        """Returns a view of the roster for the given server.
+
+        The view shares this roster's connections, so it's only usable
+        until the roster is closed, and doesn't need closing itself.
+
+        """
+        view = copy.copy(self)
+        view.server_id = server_id
+        view.close = lambda: None
+        return view
+
+    def server_ids(self):
+        """Returns the IDs of the servers with users in the roster."""
+        with self.reader() as db:
+            return [
+                row[0] for row in db.execute(
+                    'SELECT DISTINCT server_id FROM User ORDER BY server_id;')
+            ]
+
+    def user_states(self):
+        """Returns [(server_id, User, is_attending)] for every server."""
+        with self.reader() as db:
+            return [(row[0], _compact_user(*row[1:5]), bool(row[5]))
+                    for row in db.execute('''
+                        SELECT u.server_id, u.user_id, u.nick,
+                               u.discriminator, u.avatar,
+                               a.user_id IS NOT NULL
+                        FROM User u
+                        LEFT JOIN Attendance a
+                            ON a.server_id = u.server_id
+                           AND a.user_id = u.user_id;
+                    ''')]
+
+    @contextmanager
+    def reader(self):
+        """Context manager that borrows a read-only database connection."""
+        if self._readers is None:
+            yield self.db
+        else:
+            with self._readers.connection() as db:
+                yield db
 
     def set_user_attendance(self, user, is_attending):
+        self.set_users_attendance([(user, is_attending)])
+
+    def set_users_attendance(self, changes):
+        """Applies (user, is_attending) pairs in a single transaction."""
+        now = self.clock()
         with _Transaction(self.db):
-            self._upsert_user(user)
+            for user, is_attending in changes:
+                row = self.db.execute(
+                    '''
+                    SELECT nick, discriminator, avatar,
+                           EXISTS (SELECT * FROM Attendance a
+                                   WHERE a.server_id = u.server_id
+                                     AND a.user_id = u.user_id)
+                    FROM User u
+                    WHERE server_id = ? AND user_id = ?;
+                ''', (self.server_id, user.user_id)).fetchone()
 
-            if is_attending:
-                query = '''
-                    INSERT OR IGNORE INTO Attendance (user_id)
-                    VALUES (?);
-                '''
-            else:
-                query = 'DELETE FROM Attendance WHERE user_id = ?;'
+                if row is None or tuple(row[:3]) != tuple(user[1:]):
+                    self._append_event(now, 'PROFILE', user)
+                    self._upsert_user(user, now)
+
+                was_attending = row is not None and bool(row[3])
+                if is_attending == was_attending:
+                    continue
+
+                if is_attending:
+                    self._append_event(now, 'ATTENDING', user)
+                    query = '''
+                        INSERT OR IGNORE INTO Attendance (server_id, user_id)
+                        VALUES (?, ?);
+                    '''
+                else:
+                    self._append_event(now, 'NOT_ATTENDING', user)
+                    query = '''
+                        DELETE FROM Attendance
+                        WHERE server_id = ? AND user_id = ?;
+                    '''
 
-            self.db.execute(query, (user.user_id,))
+                self.db.execute(query, (self.server_id, user.user_id))
 
     def update_users(self, users):
-        """Updates the roster with the users' nicks and avatars."""
+        """Updates the roster with the users' nicks and avatars.
+
+        Only users who are new, or whose nick, discriminator or avatar
+        changed, are written.  Returns UpdateCounts.
+
+        """
         with _Transaction(self.db):
-            for user in users:
-                self._upsert_user(user)
+            return self._update_users(users, self.clock())
+
+    def sync_users(self, users, chunk_size=DEFAULT_SYNC_CHUNK_SIZE):
+        """Updates the roster from an iterable of all of a server's users.
+
+        Users are consumed and written in transactions of chunk_size, so
+        memory use doesn't grow with the size of the server.  Each chunk
+        records the sync's progress, which sync_progress reports if the
+        sync is interrupted.  Because only changed users are written,
+        syncing again resumes an interrupted sync without rewriting the
+        users it already wrote.
+
+        Returns the total UpdateCounts.
+
+        """
+        progress = self.sync_progress()
+        if progress is not None:
+            logging.info('Resuming sync of server %r after %d users',
+                         self.server_id, progress.users)
+            started = progress.started
+        else:
+            started = self.clock()
+
+        totals = UpdateCounts(0, 0, 0)
+        users = iter(users)
+        while True:
+            chunk = list(itertools.islice(users, chunk_size))
+            if not chunk:
+                break
+
+            with _Transaction(self.db):
+                counts = self._update_users(chunk, self.clock())
+                totals = UpdateCounts(*map(sum, zip(totals, counts)))
+                self._set_meta('sync_started:' + self.server_id, started)
+                self._set_meta('sync_users:' + self.server_id, sum(totals))
+
+        with _Transaction(self.db):
+            self.db.execute(
+                'DELETE FROM RosterMeta WHERE key IN (?, ?);',
+                ('sync_started:' + self.server_id,
+                 'sync_users:' + self.server_id))
+            self._set_meta('last_sync:' + self.server_id, started)
+
+        return totals
+
+    def sync_progress(self):
+        """Returns the SyncProgress of an unfinished sync, or None."""
+        with self.reader() as db:
+            row = db.execute(
+                '''
+                SELECT s.value, u.value
+                FROM RosterMeta s JOIN RosterMeta u
+                WHERE s.key = ? AND u.key = ?;
+            ''', ('sync_started:' + self.server_id,
+                  'sync_users:' + self.server_id)).fetchone()
+        return SyncProgress(*row) if row is not None else None
+
+    def _update_users(self, users, now):
+        self.db.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS UserUpdate
+                (user_id TEXT NOT NULL,
+                 nick TEXT,
+                 discriminator TEXT,
+                 avatar TEXT,
+                 PRIMARY KEY (user_id));
+        ''')
+        self.db.executemany(
+            '''
+            INSERT OR REPLACE INTO UserUpdate
+                (user_id, nick, discriminator, avatar)
+            VALUES (?, ?, ?, ?);
+        ''', map(tuple, users))
+
+        self.db.execute(
+            '''
+            INSERT INTO Event
+                (time, kind, server_id, user_id, nick, discriminator,
+                 avatar)
+            SELECT ?, 'PROFILE', ?, u.user_id, u.nick, u.discriminator,
+                   u.avatar
+            FROM UserUpdate u LEFT JOIN User v
+                ON v.server_id = ? AND u.user_id = v.user_id
+            WHERE v.user_id IS NULL
+               OR u.nick IS NOT v.nick
+               OR u.discriminator IS NOT v.discriminator
+               OR u.avatar IS NOT v.avatar
+            ORDER BY u.user_id;
+        ''', (now, self.server_id, self.server_id))
+        updated = self.db.execute(
+            '''
+            UPDATE User SET
+                nick = (SELECT nick FROM UserUpdate u
+                        WHERE u.user_id = User.user_id),
+                discriminator = (SELECT discriminator FROM UserUpdate u
+                                 WHERE u.user_id = User.user_id),
+                avatar = (SELECT avatar FROM UserUpdate u
+                          WHERE u.user_id = User.user_id),
+                updated = ?
+            WHERE server_id = ? AND user_id IN
+                (SELECT u.user_id
+                 FROM UserUpdate u JOIN User v
+                     ON v.server_id = ? AND u.user_id = v.user_id
+                 WHERE u.nick IS NOT v.nick
+                    OR u.discriminator IS NOT v.discriminator
+                    OR u.avatar IS NOT v.avatar);
+        ''', (now, self.server_id, self.server_id)).rowcount
+        inserted = self.db.execute(
+            '''
+            INSERT INTO User
+                (server_id, user_id, nick, discriminator, avatar, updated)
+            SELECT ?, user_id, nick, discriminator, avatar, ?
+            FROM UserUpdate
+            WHERE user_id NOT IN
+                (SELECT user_id FROM User WHERE server_id = ?);
+        ''', (self.server_id, now, self.server_id)).rowcount
+        total, = self.db.execute(
+            'SELECT COUNT(*) FROM UserUpdate;').fetchone()
+        self.db.execute('DELETE FROM UserUpdate;')
+
+        return UpdateCounts(inserted, updated, total - inserted - updated)
+
+    def is_attending(self, user_id):
+        with self.reader() as db:
+            row = db.execute(
+                '''
+                SELECT EXISTS (SELECT * FROM Attendance
+                               WHERE server_id = ? AND user_id = ?);
+            ''', (self.server_id, user_id)).fetchone()
+        return bool(row[0])
 
     def attending_users(self):
-        cur = self.db.cursor()
-        cur.execute('''
+        return self.iter_users(attending=True)
+
+    def all_users(self):
+        return self.iter_users()
+
+    def query_users(self,
+                    attending=None,
+                    nick_prefix=None,
+                    custom_avatar=None,
+                    updated_since=None,
+                    after=None,
+                    limit=DEFAULT_PAGE_SIZE):
+        """Returns a UserPage of users sorted by nick, then user ID.
+
+        Users can be filtered by whether they're attending, by a
+        case-insensitive nick prefix, by whether they have a custom avatar,
+        and by the time their profile was last updated.  None matches any
+        value.  To get the following page, pass the previous page's
+        next_key as after.
+
+        """
+        conditions = ['server_id = ?']
+        params = [self.server_id]
+        if attending is not None:
+            conditions.append('''
+                user_id {} (SELECT user_id FROM Attendance
+                            WHERE server_id = ?)'''.format(
+                'IN' if attending else 'NOT IN'))
+            params.append(self.server_id)
+        if nick_prefix:
+            prefix = nick_prefix.translate(_ASCII_LOWER)
+            conditions.append('nick COLLATE NOCASE >= ?')
+            params.append(prefix)
+            conditions.append('nick COLLATE NOCASE < ?')
+            bound = chr(ord(prefix[-1]) + 1)
+            if bound == 'A':
+                # NOCASE would compare 'A' as 'a', but a folded nick can't
+                # contain A-Z, so '[' is the next character after '@'.
+                bound = '['
+            params.append(prefix[:-1] + bound)
+        if custom_avatar is not None:
+            conditions.append("{}(avatar IS NOT NULL AND avatar != '')".format(
+                '' if custom_avatar else 'NOT '))
+        if updated_since is not None:
+            conditions.append('updated >= ?')
+            params.append(updated_since)
+        if after is not None:
+            conditions.append('''
+                (nick COLLATE NOCASE > ?
+                 OR (nick COLLATE NOCASE = ? AND user_id > ?))''')
+            params.extend([after[0], after[0], after[1]])
+
+        query = '''
             SELECT user_id, nick, discriminator, avatar
-            FROM Attendance NATURAL LEFT JOIN User
-            ORDER BY nick COLLATE NOCASE ASC;
-        ''')
+            FROM User
+            WHERE {}
+            ORDER BY nick COLLATE NOCASE ASC, user_id ASC
+            LIMIT ?;
+        '''.format(' AND '.join(conditions))
+        params.append(limit)
+
+        with self.reader() as db:
+            users = [_compact_user(*row) for row in db.execute(query, params)]
+
+        next_key = None
+        if len(users) == limit:
+            next_key = (users[-1].nick, users[-1].user_id)
+        return UserPage(users, next_key)
 
+    def iter_users(self, page_size=DEFAULT_PAGE_SIZE, **filters):
+        """Yields all users matching query_users filters, page by page."""
+        after = None
         while True:
-            rows = cur.fetchmany()
-            if not rows:
-                break
-            for row in rows:
-                yield User(*row)
+            page = self.query_users(after=after, limit=page_size, **filters)
+            yield from page.users
+            if page.next_key is None:
+                return
+            after = page.next_key
+
+    def export_columns(self, attending=None):
+        """Returns a UserColumns of users sorted by nick, then user ID.
+
+        Users can be filtered by whether they're attending, like
+        query_users.  The users are read in a single query, and never held
+        as User tuples.
+
+        """
+        condition = ''
+        params = [self.server_id]
+        if attending is not None:
+            condition = '''
+                AND user_id {} (SELECT user_id FROM Attendance
+                                WHERE server_id = ?)'''.format(
+                'IN' if attending else 'NOT IN')
+            params.append(self.server_id)
+
+        columns = UserColumns()
+        with self.reader() as db:
+            for row in db.execute(
+                    '''
+                    SELECT user_id, nick, discriminator, avatar
+                    FROM User
+                    WHERE server_id = ? {}
+                    ORDER BY nick COLLATE NOCASE ASC, user_id ASC;
+                '''.format(condition), params):
+                columns.append(*row)
+        return columns
+
+    def attending_users_at(self, t):
+        """Returns the users who were attending at time t, sorted by nick.
+
+        Raises ValueError if t precedes the history retained by compact.
+
+        """
+        state = self._state_at(t)
+        return sorted(
+            (user for (server_id, _), (user, is_attending) in state.items()
+             if server_id == self.server_id and is_attending),
+            key=lambda user: (user.nick or '').lower())
+
+    def snapshot(self):
+        """Records a snapshot of the roster's current state."""
+        with _Transaction(self.db):
+            self._snapshot()
+
+    def compact(self, before):
+        """Discards history from before the given time.
 
-        cur.close()
+        A snapshot of the current state is recorded, if the log has changed
+        since the last one.  Then events covered by the newest snapshot
+        taken no later than before are deleted, along with older snapshots,
+        and point-in-time queries are answered from that snapshot onward.
+        History is compacted for all servers at once.
+
+        Returns the number of events deleted.
+
+        """
+        with _Transaction(self.db):
+            last_seq, = self.db.execute(
+                'SELECT MAX(seq) FROM Snapshot;').fetchone()
+            if self._last_event_seq() != last_seq:
+                self._snapshot()
+
+            anchor = self.db.execute(
+                '''
+                SELECT seq, time FROM Snapshot
+                WHERE time <= ?
+                ORDER BY time DESC, snapshot_id DESC
+                LIMIT 1;
+            ''', (before, )).fetchone()
+            if anchor is None:
+                return 0
+
+            seq, anchor_time = anchor
+            deleted = self.db.execute('DELETE FROM Event WHERE seq <= ?;',
+                                      (seq, )).rowcount
+            self.db.execute(
+                '''
+                DELETE FROM SnapshotUser
+                WHERE snapshot_id IN
+                    (SELECT snapshot_id FROM Snapshot WHERE seq < ?);
+            ''', (seq, ))
+            self.db.execute('DELETE FROM Snapshot WHERE seq < ?;', (seq, ))
+            self._set_meta('history_start', anchor_time)
+
+        logging.info('Compacted %d roster events', deleted)
+        return deleted
+
+    def rebuild(self):
+        """Rebuilds the User and Attendance tables from the event log.
+
+        All servers' users are rebuilt.
+
+        """
+        now = self.clock()
+        state = self._state_at(now)
+        with _Transaction(self.db):
+            self.db.execute('DELETE FROM Attendance;')
+            self.db.execute('DELETE FROM User;')
+            self.db.executemany(
+                '''
+                INSERT INTO User
+                    (server_id, user_id, nick, discriminator, avatar, updated)
+                VALUES (?, ?, ?, ?, ?, ?);
+            ''', ((server_id, ) + tuple(user) + (now, )
+                  for (server_id, _), (user, _) in state.items()))
+            self.db.executemany(
+                'INSERT INTO Attendance (server_id, user_id) VALUES (?, ?);',
+                (key for key, (_, is_attending) in state.items()
+                 if is_attending))
 
     def close(self):
+        if self._readers is not None:
+            self._readers.close()
         self.db.close()
 
-    def _upsert_user(self, user):
+    def _append_event(self, t, kind, user):
+        if kind == 'PROFILE':
+            profile = tuple(user[1:])
+        else:
+            profile = (None, None, None)
+
         self.db.execute(
             '''
-            INSERT OR REPLACE INTO User (user_id, nick, discriminator, avatar)
-            VALUES (?, ?, ?, ?);
-        ''', tuple(user))
+            INSERT INTO Event
+                (time, kind, server_id, user_id, nick, discriminator, avatar)
+            VALUES (?, ?, ?, ?, ?, ?, ?);
+        ''', (t, kind, self.server_id, user.user_id) + profile)
+
+    def _set_meta(self, key, value):
+        self.db.execute(
+            'INSERT OR REPLACE INTO RosterMeta (key, value) VALUES (?, ?);',
+            (key, value))
+
+    def _last_event_seq(self):
+        # Event seqs are never reused, so the AUTOINCREMENT counter tracks
+        # the last event even after the log has been compacted.
+        row = self.db.execute('''
+            SELECT seq FROM sqlite_sequence WHERE name = 'Event';
+        ''').fetchone()
+        return row[0] if row is not None else 0
+
+    def _snapshot(self):
+        snapshot_id = self.db.execute(
+            'INSERT INTO Snapshot (seq, time) VALUES (?, ?);',
+            (self._last_event_seq(), self.clock())).lastrowid
+        self.db.execute(
+            '''
+            INSERT INTO SnapshotUser
+                (snapshot_id, server_id, user_id, nick, discriminator, avatar,
+                 attending)
+            SELECT ?, server_id, user_id, nick, discriminator, avatar,
+                   EXISTS (SELECT * FROM Attendance a
+                           WHERE a.server_id = u.server_id
+                             AND a.user_id = u.user_id)
+            FROM User u;
+        ''', (snapshot_id, ))
+
+    def _state_at(self, t):
+        """Returns {(server_id, user_id): (User, is_attending)} as of t."""
+        with self.reader() as db:
+            row = db.execute('''
+                SELECT value FROM RosterMeta WHERE key = 'history_start';
+            ''').fetchone()
+            if row is not None and t < row[0]:
+                raise ValueError(
+                    'Roster history before {} has been compacted'.format(
+                        row[0]))
+
+            state = {}
+            seq = 0
+            snapshot = db.execute(
+                '''
+                SELECT snapshot_id, seq FROM Snapshot
+                WHERE time <= ?
+                ORDER BY time DESC, snapshot_id DESC
+                LIMIT 1;
+            ''', (t, )).fetchone()
+            if snapshot is not None:
+                snapshot_id, seq = snapshot
+                for row in db.execute(
+                        '''
+                        SELECT server_id, user_id, nick, discriminator, avatar,
+                               attending
+                        FROM SnapshotUser
+                        WHERE snapshot_id = ?;
+                    ''', (snapshot_id, )):
+                    state[row[:2]] = (User(*row[1:5]), bool(row[5]))
+
+            for row in db.execute(
+                    '''
+                    SELECT kind, server_id, user_id, nick, discriminator,
+                           avatar
+                    FROM Event
+                    WHERE seq > ? AND time <= ?
+                    ORDER BY seq;
+                ''', (seq, t)):
+                kind, key = row[0], row[1:3]
+                user, is_attending = state.get(
+                    key, (User(key[1], None, None, None), False))
+                if kind == 'PROFILE':
+                    user = User(*row[2:])
+                else:
+                    is_attending = kind == 'ATTENDING'
+                state[key] = (user, is_attending)
+
+        return state
+
+    def _configure(self, db):
+        for name, value in self.pragmas:
+            if value is not None:
+                db.execute('PRAGMA {} = {};'.format(name, value))
+
+    def _connect_reader(self, db_path):
+        db = sqlite3.connect(
+            'file:{}?mode=ro'.format(
+                urllib.request.pathname2url(os.path.abspath(db_path))),
+            uri=True,
+            check_same_thread=False)
+        # The journal mode is a property of the database file, which only
+        # the writer can change.
+        for name, value in self.pragmas:
+            if value is not None and name != 'journal_mode':
+                db.execute('PRAGMA {} = {};'.format(name, value))
+        return db
+
+    def _upsert_user(self, user, t):
+        self.db.execute(
+            '''
+            INSERT OR REPLACE INTO User
+                (server_id, user_id, nick, discriminator, avatar, updated)
+            VALUES (?, ?, ?, ?, ?, ?);
+        ''', (self.server_id, ) + tuple(user) + (t, ))
+
+    def _table_columns(self, table):
+        return [
+            row[1]
+            for row in self.db.execute('PRAGMA table_info({});'.format(table))
+        ]
 
     def _init_db(self):
+        self._create_tables()
+
+        # Rosters created before User.updated existed need the column added.
+        if 'updated' not in self._table_columns('User'):
+            self.db.execute('ALTER TABLE User ADD COLUMN updated REAL;')
+        self._partition_by_server()
+
+        self.db.execute('''
+            CREATE INDEX IF NOT EXISTS User_nick
+                ON User (server_id, nick COLLATE NOCASE, user_id);
+        ''')
+        self.db.execute('''
+            CREATE INDEX IF NOT EXISTS User_updated
+                ON User (server_id, updated);
+        ''')
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS Event_time ON Event (time);')
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS Snapshot_time ON Snapshot (time);')
+
+        # Rosters created before the event log existed start their history
+        # with a snapshot of their current state.
+        with _Transaction(self.db):
+            has_history = self.db.execute('''
+                SELECT EXISTS (SELECT * FROM Event)
+                    OR EXISTS (SELECT * FROM Snapshot)
+                    OR NOT EXISTS (SELECT * FROM User);
+            ''').fetchone()[0]
+            if not has_history:
+                self._snapshot()
+                self.db.execute(
+                    '''
+                    INSERT INTO RosterMeta (key, value)
+                    VALUES ('history_start', ?);
+                ''', (self.clock(), ))
+
+    def _create_tables(self):
         # It's easy to implement _upsert_user with a single table using
         # Sqlite 3.24's "ON CONFLICT ... DO UPDATE" syntax, but this way
         # the program won't require a Python built against the very latest
         # sqlite3.
         self.db.execute('''
             CREATE TABLE IF NOT EXISTS User
-                (user_id TEXT NOT NULL,
+                (server_id TEXT NOT NULL,
+                 user_id TEXT NOT NULL,
                  nick TEXT,
                  discriminator TEXT,
                  avatar TEXT,
-                 PRIMARY KEY (user_id));
+                 updated REAL,
+                 PRIMARY KEY (server_id, user_id));
         ''')
         self.db.execute('''
             CREATE TABLE IF NOT EXISTS Attendance
-                (user_id TEXT NOT NULL UNIQUE,
-                 FOREIGN KEY (user_id) REFERENCES User (user_id));
+                (server_id TEXT NOT NULL,
+                 user_id TEXT NOT NULL,
+                 PRIMARY KEY (server_id, user_id),
+                 FOREIGN KEY (server_id, user_id)
+                     REFERENCES User (server_id, user_id));
         ''')
 
+        # Append-only log of changes to users and attendance.  Kind is one
+        # of PROFILE, ATTENDING or NOT_ATTENDING; the profile columns are
+        # only set for PROFILE events.
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS Event
+                (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                 time REAL NOT NULL,
+                 kind TEXT NOT NULL,
+                 server_id TEXT NOT NULL,
+                 user_id TEXT NOT NULL,
+                 nick TEXT,
+                 discriminator TEXT,
+                 avatar TEXT);
+        ''')
+
+        # Snapshots of the roster's state after the event with the given
+        # seq.
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS Snapshot
+                (snapshot_id INTEGER PRIMARY KEY,
+                 seq INTEGER NOT NULL,
+                 time REAL NOT NULL);
+        ''')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS SnapshotUser
+                (snapshot_id INTEGER NOT NULL,
+                 server_id TEXT NOT NULL,
+                 user_id TEXT NOT NULL,
+                 nick TEXT,
+                 discriminator TEXT,
+                 avatar TEXT,
+                 attending INTEGER NOT NULL,
+                 PRIMARY KEY (snapshot_id, server_id, user_id),
+                 FOREIGN KEY (snapshot_id) REFERENCES Snapshot (snapshot_id));
+        ''')
+
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS RosterMeta
+                (key TEXT NOT NULL,
+                 value,
+                 PRIMARY KEY (key));
+        ''')
+
+    def _partition_by_server(self):
+        """Assigns users of a roster from before servers were partitioned.
+
+        Tables without a server_id column are recreated with one, and their
+        rows are assigned to this roster's server.  Raises ValueError if
+        there are rows to assign but no server, since no server would ever
+        read them.
+
+        """
+        with _Transaction(self.db):
+            unassigned = [
+                table
+                for table in ['Event', 'Attendance', 'User', 'SnapshotUser']
+                if 'server_id' not in self._table_columns(table)
+            ]
+            if not self.server_id and any(
+                    self.db.execute('SELECT EXISTS (SELECT * FROM {});'.format(
+                        table)).fetchone()[0] for table in unassigned):
+                raise ValueError(
+                    'Roster predates servers; open it with a server ID to '
+                    'assign its users to')
+
+            if 'Event' in unassigned:
+                self.db.execute('''
+                    ALTER TABLE Event
+                    ADD COLUMN server_id TEXT NOT NULL DEFAULT '';
+                ''')
+                self.db.execute('UPDATE Event SET server_id = ?;',
+                                (self.server_id, ))
+
+            # SQLite can't change a table's primary key, so these are copied
+            # into new tables.
+            legacy = [table for table in unassigned if table != 'Event']
+            if not legacy:
+                return
+
+            for table in legacy:
+                self.db.execute('ALTER TABLE {0} RENAME TO {0}_legacy;'.format(
+                    table))
+            self._create_tables()
+            for table in legacy:
+                columns = ', '.join(
+                    self._table_columns('{}_legacy'.format(table)))
+                self.db.execute(
+                    '''
+                    INSERT INTO {0} (server_id, {1})
+                    SELECT ?, {1} FROM {0}_legacy;
+                '''.format(table, columns), (self.server_id, ))
+                self.db.execute('DROP TABLE {}_legacy;'.format(table))
+
+            logging.info('Assigned existing roster to server %r',
+                         self.server_id)
+
     def __enter__(self):
         return self
 
@@ -114,50 +887,293 @@ class Roster:
         self.close()
 
 
-class AvatarCache:
-    """Loading cache of user avatars."""
+class UserColumns:
+    """A sequence of Users, stored column by column.
+
+    User IDs that are Discord snowflakes are packed into an array of 64-bit
+    integers, and discriminators are interned, so a large roster costs
+    little more than its nicks and avatars.  Indexing returns a User, and
+    slicing returns another UserColumns.
+
+    """
+
+    def __init__(self):
+        self.user_ids = array('Q')
+        self.nicks = []
+        self.discriminators = []
+        self.avatars = []
+
+    def append(self, user_id, nick, discriminator, avatar):
+        packed = _packed_id(user_id)
+        if packed is None and isinstance(self.user_ids, array):
+            self.user_ids = [str(i) for i in self.user_ids]
+        self.user_ids.append(user_id if packed is None else packed)
+        self.nicks.append(nick)
+        self.discriminators.append(_intern(discriminator))
+        self.avatars.append(avatar)
+
+    def __len__(self):
+        return len(self.nicks)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            columns = UserColumns()
+            columns.user_ids = self.user_ids[i]
+            columns.nicks = self.nicks[i]
+            columns.discriminators = self.discriminators[i]
+            columns.avatars = self.avatars[i]
+            return columns
+
+        return User(
+            str(self.user_ids[i]), self.nicks[i], self.discriminators[i],
+            self.avatars[i])
+
+    def __iter__(self):
+        for row in zip(self.user_ids, self.nicks, self.discriminators,
+                       self.avatars):
+            yield User(str(row[0]), *row[1:])
+
+
+class _BaseAvatarCache:
+    """Cache layout and response handling shared by the avatar caches.
+
+    Alongside the cached images, an index records each file's HTTP
+    validators, size and content hash.  A cached file whose size doesn't
+    match the index is treated as a miss.  In revalidate mode, the file's
+    hash is checked too, and every lookup sends a conditional request to
+    the CDN, with a 304 response counting as a hit.  Each file is
+    revalidated at most once per cache instance.
+
+    The cache can optionally be bounded to max_bytes and max_entries, in
+    which case the least recently used avatars are evicted to make room
+    for new ones.  Eviction happens after each lookup that cached a new
+    avatar, or within a batch, once the batch finishes; avatars looked up
+    in the batch are never evicted at its end.
+
+    If a size is given, avatars of that width and height in pixels are
+    requested from the CDN instead of full-size images.  Avatars of
+    different sizes are cached side by side.
+
+    Avatars are streamed into a temporary file and renamed into place once
+    complete, so a cached file is never partially written.  Responses
+    larger than max_avatar_bytes, or that aren't PNG images, are rejected.
+
+    """
+
+    def __init__(self,
+                 cache_path,
+                 revalidate=False,
+                 max_bytes=None,
+                 max_entries=None,
+                 max_avatar_bytes=DEFAULT_MAX_AVATAR_BYTES,
+                 size=None):
+        if size is not None and size not in AVATAR_SIZES:
+            raise ValueError('Invalid avatar size {}'.format(size))
 
-    def __init__(self, cache_path):
         self.cache_path = cache_path
+        self.size = size
+        self.revalidate = revalidate
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_avatar_bytes = max_avatar_bytes
         _makedirs(cache_path)
+        self._index = _AvatarIndex(os.path.join(cache_path, 'index.db'))
+        self._revalidated = set()
+        # Filenames looked up in the current batch, or None outside one.
+        self._batch = None
+        self._batch_depth = 0
+        self._eviction_pending = False
 
-    def get_avatar(self, user, path):
-        self._cache_avatar(user)
-        shutil.copyfile(self._avatar_cache_path(user), path)
+    @contextmanager
+    def batch(self):
+        """Context manager that defers eviction until the batch finishes.
 
-    def _cache_avatar(self, user):
-        cache_path = self._avatar_cache_path(user)
-        if os.path.exists(cache_path):
-            logging.debug('Avatar cache hit at %s', cache_path)
+        Avatars looked up in the batch are kept, even if that leaves the
+        cache over its limits.  Batches may be nested.
+
+        """
+        if self._batch_depth == 0:
+            self._batch = set()
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                keep, self._batch = self._batch, None
+                if self._eviction_pending:
+                    self.evict(keep)
+
+    def evict(self, keep=()):
+        """Evicts least recently used avatars beyond the cache's limits.
+
+        Avatars whose filenames are in keep are never evicted.
+
+        """
+        self._eviction_pending = False
+        if self.max_bytes is None and self.max_entries is None:
             return
 
-        resp = requests.get(self._avatar_url(user))
-        if not resp.ok:
-            if resp.status_code == 404:
-                raise ValueError('Invalid avatar: {}'.format(resp.reason))
+        evicted = self._index.evict(self.max_bytes, self.max_entries, keep)
+        for filename in evicted:
+            self._remove_cache_file(filename)
+
+        if evicted:
+            logging.info('Evicted %d avatars from cache', len(evicted))
+
+    def sweep_orphans(self, roster):
+        """Removes cached avatars that no user in the roster refers to.
+
+        Users of all the roster's servers are considered.  Returns the
+        number of avatars removed.
+
+        """
+        live = set(
+            _source_stem(os.path.basename(self._avatar_cache_path(user)))
+            for server_id in roster.server_ids()
+            for user in roster.for_server(server_id).all_users())
+        cached = set(self._index.filenames())
+        cached.update(
+            filename for filename in os.listdir(self.cache_path)
+            if filename.endswith('.png'))
+
+        # Temporary files left behind by interrupted downloads.
+        stale = time.time() - _STALE_TMP_SECONDS
+        cached.update(
+            filename for filename in os.listdir(self.cache_path)
+            if filename.endswith('.tmp') and os.path.getmtime(
+                os.path.join(self.cache_path, filename)) < stale)
+
+        orphans = set(filename for filename in cached
+                      if _source_stem(filename) not in live)
+        self._index.remove(orphans)
+        for filename in orphans:
+            self._remove_cache_file(filename)
+
+        logging.info('Swept %d orphaned avatars from cache', len(orphans))
+        return len(orphans)
+
+    def _normalized_avatar(self, cache_path, avatar_format):
+        """Returns the path of a normalized variant of a cached avatar.
+
+        The variant is cached alongside the original, and is regenerated
+        whenever the original is refetched.
+
+        """
+        variant_path = '{}@{}px{}.png'.format(
+            os.path.splitext(cache_path)[0], avatar_format.pixels,
+            '-circle' if avatar_format.circle else '')
+
+        entry = self._cached_entry(variant_path)
+        if (entry is not None and os.path.getmtime(variant_path) >=
+                os.path.getmtime(cache_path)):
+            self._index.touch(entry.filename)
+            return variant_path
+
+        with self._cache_file_writer(variant_path, {}) as writer:
+            writer.write(_normalize_image(cache_path, avatar_format))
+
+        logging.debug('Normalized avatar at %s', variant_path)
+        return variant_path
+
+    def _remove_cache_file(self, filename):
+        try:
+            os.remove(os.path.join(self.cache_path, filename))
+        except FileNotFoundError:
+            pass
+
+    def _is_fresh(self, cache_path, entry):
+        if entry is None:
+            return False
+        if self.revalidate and cache_path not in self._revalidated:
+            return False
+
+        logging.debug('Avatar cache hit at %s', cache_path)
+        self._index.touch(entry.filename)
+        return True
+
+    def _cached_entry(self, cache_path):
+        """Returns the index entry for a valid cached file, or None."""
+        try:
+            size = os.path.getsize(cache_path)
+        except FileNotFoundError:
+            return None
+
+        filename = os.path.basename(cache_path)
+        entry = self._index.get(filename)
+        if entry is None:
+            # Files cached before the index existed are adopted as-is.
+            return self._index.put(filename, _file_sha256(cache_path), size)
+
+        if entry.size != size:
+            logging.warning('Cached avatar %s has the wrong size', cache_path)
+            return None
+        if (self.revalidate and cache_path not in self._revalidated
+                and entry.sha256 != _file_sha256(cache_path)):
+            logging.warning('Cached avatar %s is corrupt', cache_path)
+            return None
+
+        return entry
+
+    @staticmethod
+    def _request_headers(entry):
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def _check_response(self, status, reason, headers):
+        if not 200 <= status < 400:
+            if status == 404:
+                raise ValueError('Invalid avatar: {}'.format(reason))
             else:
-                raise Exception('Error getting avatar: {}'.format(resp.reason))
+                raise Exception('Error getting avatar: {}'.format(reason))
 
-        content_type = resp.headers['Content-Type']
+        content_type = headers['Content-Type']
         if content_type != 'image/png':
             raise ValueError(
                 'Unexpected avatar content type {}'.format(content_type))
 
-        with open(cache_path, 'wb') as f:
-            f.truncate()
-            f.write(resp.content)
+        content_length = headers.get('Content-Length')
+        if (content_length is not None
+                and int(content_length) > self.max_avatar_bytes):
+            raise ValueError(
+                'Avatar is too large: {} bytes'.format(content_length))
+
+    def _cache_file_writer(self, cache_path, headers):
+        return _CacheFileWriter(self, cache_path, headers)
 
+    def _commit_cache_file(self, cache_path, sha256, size, headers):
+        self._index.put(
+            os.path.basename(cache_path),
+            sha256,
+            size,
+            etag=headers.get('ETag'),
+            last_modified=headers.get('Last-Modified'))
+        self._revalidated.add(cache_path)
         logging.debug('Cached new avatar at %s', cache_path)
+        self._eviction_pending = True
+
+    def _looked_up(self, *cache_paths):
+        """Records a lookup of cached avatars, evicting others if needed."""
+        filenames = [os.path.basename(path) for path in cache_paths]
+        if self._batch is not None:
+            self._batch.update(filenames)
+        elif self._eviction_pending:
+            self.evict(filenames)
 
     def _avatar_cache_path(self, user):
         if user.avatar:
-            return os.path.join(
-                self.cache_path,
-                '{user_id}_{avatar}.png'.format(**user._asdict()))
+            stem = '{user_id}_{avatar}'.format(**user._asdict())
         else:
-            return os.path.join(
-                self.cache_path, 'default_{}.png'.format(
-                    self._default_avatar(user)))
+            stem = 'default_{}'.format(self._default_avatar(user))
+
+        if self.size is not None:
+            stem += '.{}'.format(self.size)
+        return os.path.join(self.cache_path, stem + '.png')
 
     @staticmethod
     def _default_avatar(user):
@@ -166,14 +1182,426 @@ class AvatarCache:
         except ValueError:
             return '0'
 
-    @classmethod
-    def _avatar_url(klass, user):
+    def _avatar_url(self, user):
         if user.avatar:
-            return CDN_PREFIX + 'avatars/{user_id}/{avatar}.png'.format(
+            url = CDN_PREFIX + 'avatars/{user_id}/{avatar}.png'.format(
                 **user._asdict())
         else:
-            return CDN_PREFIX + 'embed/avatars/{}.png'.format(
-                klass._default_avatar(user))
+            url = CDN_PREFIX + 'embed/avatars/{}.png'.format(
+                self._default_avatar(user))
+
+        if self.size is not None:
+            url += '?size={}'.format(self.size)
+        return url
+
+
+class AvatarCache(_BaseAvatarCache):
+    """Loading cache of user avatars.
+
+    Avatars are downloaded through a single requests session, so that
+    connections to the CDN are kept alive and reused between fetches.
+
+    """
+
+    def __init__(self, cache_path, pool_size=DEFAULT_POOL_SIZE, **kwargs):
+        super().__init__(cache_path, **kwargs)
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount(CDN_PREFIX, adapter)
+
+    def get_avatar(self, user, path, method='copy', avatar_format=None):
+        """Writes the user's avatar to path.
+
+        The method is one of MATERIALIZE_METHODS.  Note that symlinks
+        break if the avatar is later evicted from the cache.  If an
+        AvatarFormat is given, the avatar is normalized to that format,
+        which requires Pillow.
+
+        """
+        cache_path = self._cache_avatar(user, avatar_format)
+        _materialize(cache_path, path, method)
+
+    def avatar_digest(self, user, avatar_format=None):
+        """Returns the SHA-256 hex digest of the user's cached avatar."""
+        cache_path = self._cache_avatar(user, avatar_format)
+        return self._index.get(os.path.basename(cache_path)).sha256
+
+    def prefetch(self,
+                 users,
+                 max_workers=DEFAULT_POOL_SIZE,
+                 avatar_format=None):
+        """Caches the avatars of many users concurrently.
+
+        At most max_workers avatars are downloaded (and normalized, if an
+        AvatarFormat is given) at once.  A failure to fetch one user's
+        avatar does not stop the rest of the batch; instead, failures are
+        returned as a list of (user, exception) pairs.
+
+        """
+        # Users without a custom avatar share default avatar files, so
+        # only fetch each cache path once to avoid racing writers.
+        pending = {}
+        for user in users:
+            pending.setdefault(self._avatar_cache_path(user), []).append(user)
+
+        def fetch(cache_users):
+            try:
+                self._cache_avatar(cache_users[0], avatar_format)
+            except Exception as e:
+                return [(user, e) for user in cache_users]
+            return []
+
+        failures = []
+        with self.batch(), ThreadPoolExecutor(
+                max_workers=max_workers) as executor:
+            for result in executor.map(fetch, pending.values()):
+                failures.extend(result)
+
+        return failures
+
+    def close(self):
+        self.session.close()
+        self._index.close()
+
+    def _cache_avatar(self, user, avatar_format=None):
+        """Caches the user's avatar, returning its path in the cache."""
+        cache_path = self._avatar_cache_path(user)
+        self._fetch(user, cache_path)
+
+        if avatar_format is None:
+            self._looked_up(cache_path)
+            return cache_path
+        variant_path = self._normalized_avatar(cache_path, avatar_format)
+        self._looked_up(cache_path, variant_path)
+        return variant_path
+
+    def _fetch(self, user, cache_path):
+        entry = self._cached_entry(cache_path)
+        if self._is_fresh(cache_path, entry):
+            return
+
+        resp = self.session.get(
+            self._avatar_url(user),
+            headers=self._request_headers(entry),
+            stream=True)
+        # Closing the response releases its connection to the pool, even
+        # when the body isn't read.
+        with resp:
+            if entry is not None and resp.status_code == 304:
+                logging.debug('Revalidated cached avatar at %s', cache_path)
+                self._revalidated.add(cache_path)
+                self._index.touch(entry.filename)
+                return
+
+            self._check_response(resp.status_code, resp.reason, resp.headers)
+            with self._cache_file_writer(cache_path, resp.headers) as writer:
+                for chunk in resp.iter_content(_CHUNK_SIZE):
+                    writer.write(chunk)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+class AsyncAvatarCache(_BaseAvatarCache):
+    """Loading cache of user avatars for use on an asyncio event loop.
+
+    This shares its cache directory layout with AvatarCache, so avatars
+    fetched by the bot as users sign up are already on disk by the time
+    nametags are printed.  Concurrent requests for the same avatar are
+    coalesced into a single download.
+
+    """
+
+    def __init__(self, cache_path, session=None, **kwargs):
+        super().__init__(cache_path, **kwargs)
+        self._session = session
+        self._in_flight = {}
+
+    @property
+    def session(self):
+        # Created lazily so that the session binds to the running loop.
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def get_avatar(self, user, path, method='copy'):
+        await self.cache_avatar(user)
+        _materialize(self._avatar_cache_path(user), path, method)
+
+    async def cache_avatar(self, user):
+        """Ensures that the user's avatar is in the cache."""
+        cache_path = self._avatar_cache_path(user)
+        fetch = self._in_flight.get(cache_path)
+        if fetch is None:
+            entry = self._cached_entry(cache_path)
+            if self._is_fresh(cache_path, entry):
+                self._looked_up(cache_path)
+                return
+
+            fetch = asyncio.ensure_future(
+                self._fetch(user, cache_path, entry))
+            self._in_flight[cache_path] = fetch
+            fetch.add_done_callback(
+                lambda _: self._in_flight.pop(cache_path, None))
+
+        await asyncio.shield(fetch)
+        self._looked_up(cache_path)
+
+    async def prefetch(self, users, max_workers=DEFAULT_POOL_SIZE):
+        """Caches the avatars of many users concurrently.
+
+        Returns failures as a list of (user, exception) pairs, like
+        AvatarCache.prefetch.
+
+        """
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def fetch(user):
+            async with semaphore:
+                try:
+                    await self.cache_avatar(user)
+                except Exception as e:
+                    return (user, e)
+
+        with self.batch():
+            results = await asyncio.gather(*map(fetch, users))
+        return [result for result in results if result is not None]
+
+    async def close(self):
+        try:
+            if self._session is not None:
+                session, self._session = self._session, None
+                result = session.close()
+                if inspect.isawaitable(result):
+                    await result
+        finally:
+            self._index.close()
+
+    async def _fetch(self, user, cache_path, entry):
+        async with self.session.get(
+                self._avatar_url(user),
+                headers=self._request_headers(entry)) as resp:
+            if entry is not None and resp.status == 304:
+                logging.debug('Revalidated cached avatar at %s', cache_path)
+                self._revalidated.add(cache_path)
+                self._index.touch(entry.filename)
+                return
+
+            self._check_response(resp.status, resp.reason, resp.headers)
+            with self._cache_file_writer(cache_path, resp.headers) as writer:
+                while True:
+                    chunk = await resp.content.read(_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+
+
+class _CacheFileWriter:
+    """Context manager that atomically writes a file into an avatar cache.
+
+    The avatar is validated as it's written.  It's renamed into place, and
+    recorded in the cache's index, only if the context exits without an
+    exception.
+
+    """
+
+    def __init__(self, cache, cache_path, headers):
+        self.cache = cache
+        self.cache_path = cache_path
+        self.headers = headers
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.signature = b''
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.cache.max_avatar_bytes:
+            raise ValueError('Avatar is too large: over {} bytes'.format(
+                self.cache.max_avatar_bytes))
+
+        missing = len(_PNG_SIGNATURE) - len(self.signature)
+        if missing > 0:
+            self.signature += chunk[:missing]
+            if not _PNG_SIGNATURE.startswith(self.signature):
+                raise ValueError('Avatar is not a PNG image')
+
+        self.sha256.update(chunk)
+        self.f.write(chunk)
+
+    def __enter__(self):
+        fd, self.tmp_path = tempfile.mkstemp(
+            dir=self.cache.cache_path, prefix='.', suffix='.tmp')
+        self.f = os.fdopen(fd, 'wb')
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.f.close()
+        if type is not None:
+            os.remove(self.tmp_path)
+            return False
+
+        if self.signature != _PNG_SIGNATURE:
+            os.remove(self.tmp_path)
+            raise ValueError('Avatar is not a PNG image')
+
+        # Renaming replaces, rather than overwrites, any existing file,
+        # which may be hardlinked into an output directory.
+        os.replace(self.tmp_path, self.cache_path)
+        self.cache._commit_cache_file(self.cache_path,
+                                      self.sha256.hexdigest(), self.size,
+                                      self.headers)
+
+
+_AvatarIndexEntry = namedtuple(
+    '_AvatarIndexEntry',
+    ['filename', 'etag', 'last_modified', 'size', 'sha256', 'accessed'])
+
+
+class _AvatarIndex:
+    """Metadata about the files in an avatar cache.
+
+    Threadsafe.
+
+    """
+
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(
+            db_path, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        # The index only describes the cache, and entries that don't match
+        # their files are discarded anyway, so durability isn't worth an
+        # fsync per avatar.
+        self.db.execute('PRAGMA synchronous = OFF;')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS Avatar
+                (filename TEXT NOT NULL,
+                 etag TEXT,
+                 last_modified TEXT,
+                 size INTEGER NOT NULL,
+                 sha256 TEXT NOT NULL,
+                 accessed REAL NOT NULL,
+                 PRIMARY KEY (filename));
+        ''')
+
+    def get(self, filename):
+        with self.lock:
+            row = self.db.execute(
+                '''
+                SELECT filename, etag, last_modified, size, sha256, accessed
+                FROM Avatar
+                WHERE filename = ?;
+            ''', (filename, )).fetchone()
+
+        if row is None:
+            return None
+        return _AvatarIndexEntry(*row)
+
+    def put(self, filename, sha256, size, etag=None, last_modified=None):
+        entry = _AvatarIndexEntry(filename, etag, last_modified, size, sha256,
+                                  time.time())
+        with self.lock:
+            self.db.execute(
+                '''
+                INSERT OR REPLACE INTO Avatar
+                    (filename, etag, last_modified, size, sha256, accessed)
+                VALUES (?, ?, ?, ?, ?, ?);
+            ''', tuple(entry))
+        return entry
+
+    def touch(self, filename):
+        with self.lock:
+            self.db.execute(
+                'UPDATE Avatar SET accessed = ? WHERE filename = ?;',
+                (time.time(), filename))
+
+    def filenames(self):
+        with self.lock:
+            rows = self.db.execute('SELECT filename FROM Avatar;').fetchall()
+        return [row[0] for row in rows]
+
+    def remove(self, filenames):
+        with self.lock, _Transaction(self.db):
+            self.db.executemany('DELETE FROM Avatar WHERE filename = ?;',
+                                [(filename, ) for filename in filenames])
+
+    def evict(self, max_bytes=None, max_entries=None, keep=()):
+        """Removes least recently accessed entries to fit within limits.
+
+        Entries whose filenames are in keep count towards the limits, but
+        are never removed.  Returns the filenames of the evicted entries.
+
+        """
+        keep = set(keep)
+        with self.lock, _Transaction(self.db):
+            rows = self.db.execute('''
+                SELECT filename, size FROM Avatar ORDER BY accessed DESC;
+            ''').fetchall()
+
+            # Kept entries take their room first, as if just accessed.
+            rows.sort(key=lambda row: row[0] not in keep)
+            total_bytes = 0
+            evicted = []
+            for i, (filename, size) in enumerate(rows):
+                total_bytes += size
+                if filename in keep:
+                    continue
+                if ((max_bytes is not None and total_bytes > max_bytes) or
+                        (max_entries is not None and i >= max_entries)):
+                    evicted.append(filename)
+
+            self.db.executemany('DELETE FROM Avatar WHERE filename = ?;',
+                                [(filename, ) for filename in evicted])
+
+        return evicted
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class _ConnectionPool:
+    """Pool of database connections, which are opened on demand.
+
+    Threadsafe.
+
+    """
+
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.lock = threading.Lock()
+        self.available = queue.LifoQueue()
+        self.opened = []
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        self.slots.acquire()
+        try:
+            try:
+                db = self.available.get_nowait()
+            except queue.Empty:
+                db = self.connect()
+                with self.lock:
+                    self.opened.append(db)
+
+            try:
+                yield db
+            finally:
+                self.available.put(db)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            for db in self.opened:
+                db.close()
+            self.opened = []
 
 
 class _Transaction:
@@ -199,6 +1627,141 @@ class _Transaction:
         self.db.__exit__(*args)
 
 
+def _compact_user(user_id, nick, discriminator, avatar):
+    """Returns a User whose discriminator is shared with other Users."""
+    return User(user_id, nick, _intern(discriminator), avatar)
+
+
+def _intern(value):
+    return value if value is None else sys.intern(value)
+
+
+def _packed_id(user_id):
+    """Returns a user ID as an unsigned 64-bit int, or None if it isn't one.
+
+    Only IDs that str() turns back into the same string are packed.
+
+    """
+    if _CANONICAL_ID_PATTERN.fullmatch(user_id) is None:
+        return None
+    packed = int(user_id)
+    return packed if packed < 2**64 else None
+
+
+def _normalize_image(path, avatar_format):
+    """Returns PNG data for the image at path in the given AvatarFormat."""
+    if Image is None:
+        raise RuntimeError('Pillow is required to normalize avatars')
+
+    size = (avatar_format.pixels, avatar_format.pixels)
+    with Image.open(path) as image:
+        image = ImageOps.fit(image.convert('RGBA'), size, Image.LANCZOS)
+
+    if avatar_format.circle:
+        # Draw the mask at a larger size and scale it down, to antialias
+        # the circle's edge.
+        mask = Image.new('L', (4 * size[0], 4 * size[1]), 0)
+        ImageDraw.Draw(mask).ellipse((0, 0) + mask.size, fill=255)
+        mask = mask.resize(size, Image.LANCZOS)
+        image.putalpha(ImageChops.multiply(image.getchannel('A'), mask))
+
+    output = io.BytesIO()
+    image.save(output, 'PNG', optimize=True)
+    return output.getvalue()
+
+
+def _source_stem(filename):
+    """Returns the user avatar that a cached file was derived from.
+
+    Avatars are cached as {stem}.png, or {stem}.{size}.png for sized
+    avatars, and their normalized variants add a suffix starting with @.
+
+    """
+    return re.split('[.@]', filename, 1)[0]
+
+
+def _materialize(src, dst, method):
+    """Makes the file at src available at dst using the given method.
+
+    Methods other than copy fall back to copying when the filesystem
+    doesn't support them.  Any existing file at dst is replaced.
+
+    """
+    if method not in MATERIALIZE_METHODS:
+        raise ValueError('Unknown materialize method {}'.format(method))
+
+    tmp = '{}.{}.tmp'.format(dst, os.getpid())
+    try:
+        if method in ('auto', 'reflink'):
+            try:
+                _reflink(src, tmp)
+                method = 'reflink'
+            except OSError:
+                method = 'hardlink' if method == 'auto' else 'copy'
+
+        if method == 'hardlink':
+            try:
+                os.link(src, tmp)
+            except OSError:
+                method = 'copy'
+        elif method == 'symlink':
+            try:
+                os.symlink(os.path.abspath(src), tmp)
+            except OSError:
+                method = 'copy'
+
+        if method == 'copy':
+            shutil.copyfile(src, tmp)
+
+        os.replace(tmp, dst)
+
+        # Renaming a link over another link to the same file does nothing,
+        # which leaves tmp behind.
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _reflink(src, dst):
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported')
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def _pragma_keyword(value, allowed):
+    if value is None:
+        return None
+    if value.lower() not in allowed:
+        raise ValueError('Invalid pragma value {}'.format(value))
+    return value.lower()
+
+
+def _pragma_int(value):
+    if value is None:
+        return None
+    return int(value)
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def _makedirs(dir_path):
     os.makedirs(dir_path, 0o750, exist_ok=True)
 
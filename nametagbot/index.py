@@ -0,0 +1,83 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import threading
+
+__all__ = ['RosterIndex']
+
+
+class RosterIndex:
+    """In-memory index of the roster's profiles and attendance.
+
+    The index is loaded from a roster, and kept coherent by writing
+    through to it: once the roster actor commits a change, it applies the
+    same change to the index.  Changes made by other processes, such as
+    nametagbot-updateroster, are only picked up when the index is loaded
+    again.
+
+    Only one thread may change the index, but queries may be made from any
+    thread.
+
+    """
+
+    def __init__(self):
+        # {(server_id, user_id): User}
+        self.profiles = {}
+        # {(server_id, user_id)}
+        self.attending = set()
+        self.loaded = threading.Event()
+
+    def load(self, roster):
+        """Replaces the index's contents with the roster's current state."""
+        profiles = {}
+        attending = set()
+        for server_id, user, is_attending in roster.user_states():
+            key = (server_id, user.user_id)
+            profiles[key] = user
+            if is_attending:
+                attending.add(key)
+
+        self.profiles = profiles
+        self.attending = attending
+        self.loaded.set()
+
+    def is_attending(self, server_id, user_id):
+        return (server_id, user_id) in self.attending
+
+    def profile(self, server_id, user_id):
+        """Returns the user's User, or None if they're not in the roster."""
+        return self.profiles.get((server_id, user_id))
+
+    def state(self, server_id, user_id):
+        """Returns the user's (User or None, is_attending)."""
+        key = (server_id, user_id)
+        return self.profiles.get(key), key in self.attending
+
+    def set_users_attendance(self, server_id, changes):
+        """Applies (user, is_attending) pairs committed to the roster."""
+        for user, is_attending in changes:
+            key = (server_id, user.user_id)
+            self.profiles[key] = user
+            if is_attending:
+                self.attending.add(key)
+            else:
+                self.attending.discard(key)
+
+    def update_users(self, server_id, users):
+        """Applies profiles committed to the roster."""
+        for user in users:
+            self.profiles[(server_id, user.user_id)] = user
+
+    def __len__(self):
+        return len(self.profiles)
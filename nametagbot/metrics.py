@@ -0,0 +1,122 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import bisect
+import logging
+import threading
+
+__all__ = ['Histogram', 'Metrics']
+
+# Default histogram bucket upper bounds, suitable for latencies in seconds.
+LATENCY_BUCKETS = [
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60
+]
+
+
+class Histogram:
+    """Distribution of observed values in fixed buckets.
+
+    Not threadsafe.
+
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Returns an upper bound for the q-th quantile of the values."""
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def __str__(self):
+        if self.count == 0:
+            return 'count=0'
+        return ('count={} mean={:.6g} p50<={:.6g} p95<={:.6g} '
+                'max={:.6g}').format(self.count, self.total / self.count,
+                                     self.quantile(0.5), self.quantile(0.95),
+                                     self.max)
+
+
+class Metrics:
+    """Named counters, gauges and histograms.
+
+    Threadsafe.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def counter(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def gauge(self, name):
+        with self.lock:
+            return self.gauges.get(name)
+
+    def histogram(self, name):
+        with self.lock:
+            return self.histograms.get(name)
+
+    def log(self, level=logging.INFO):
+        """Logs the current value of every metric."""
+        with self.lock:
+            lines = (['{} = {}'.format(name, value)
+                      for name, value in sorted(self.counters.items())] +
+                     ['{} = {}'.format(name, value)
+                      for name, value in sorted(self.gauges.items())] +
+                     ['{}: {}'.format(name, histogram)
+                      for name, histogram in sorted(self.histograms.items())])
+
+        for line in lines:
+            logging.log(level, 'Metric %s', line)
@@ -0,0 +1,109 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import os
+import sqlite3
+import threading
+
+from nametagbot import User
+
+__all__ = ['Spool']
+
+
+class Spool:
+    """Durable queue of roster attendance messages.
+
+    Messages such as ('ATTENDING', server_id, User(...)) are appended to an
+    SQLite database before they're handed to the roster actor, and removed
+    once the actor has committed them to the roster, so that they survive
+    a crash and can be replayed.
+
+    Threadsafe.
+
+    """
+
+    def __init__(self, db_path):
+        os.makedirs(
+            os.path.dirname(os.path.abspath(db_path)), 0o750, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            db_path,
+            isolation_level=None,  # Autocommit.
+            check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = WAL;')
+
+        # Each append must be on disk before the message is acknowledged.
+        self.db.execute('PRAGMA synchronous = FULL;')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS SpooledMessage
+                (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                 time REAL NOT NULL,
+                 message TEXT NOT NULL);
+        ''')
+
+    def append(self, message, t):
+        """Appends a message received at time t, and returns its seq."""
+        with self.lock:
+            return self.db.execute(
+                'INSERT INTO SpooledMessage (time, message) VALUES (?, ?);',
+                (t, _encode(message))).lastrowid
+
+    def pending(self, after=0, limit=-1):
+        """Returns [(seq, time, message)] not yet acknowledged, oldest first.
+
+        At most limit messages with seqs greater than after are returned.
+
+        """
+        with self.lock:
+            rows = self.db.execute(
+                '''
+                SELECT seq, time, message FROM SpooledMessage
+                WHERE seq > ?
+                ORDER BY seq
+                LIMIT ?;
+            ''', (after, limit)).fetchall()
+        return [(seq, t, _decode(message)) for seq, t, message in rows]
+
+    def ack(self, seqs):
+        """Removes the messages with the given seqs."""
+        with self.lock:
+            self.db.execute('BEGIN;')
+            self.db.executemany('DELETE FROM SpooledMessage WHERE seq = ?;',
+                                ((seq, ) for seq in seqs))
+            self.db.execute('COMMIT;')
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute(
+                'SELECT COUNT(*) FROM SpooledMessage;').fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+def _encode(message):
+    kind, server_id, user = message
+    return json.dumps([kind, server_id, list(user)])
+
+
+def _decode(data):
+    kind, server_id, user = json.loads(data)
+    return (kind, server_id, User(*user))
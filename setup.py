@@ -26,6 +26,7 @@ setup(
             'nametagbot=nametagbot.cmd_nametagbot:main',
         ],
     },
+    extras_require={'normalize': ['Pillow']},
     setup_requires=['pytest-runner'],
     tests_require=['pytest', 'responses'],
     test_suite='tests',
@@ -0,0 +1,118 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import asyncio
+from collections import namedtuple
+import threading
+import time
+
+from nametagbot import User
+from nametagbot.ack import Acknowledger, Completion, RateLimiter
+from nametagbot.metrics import Metrics
+
+Request = namedtuple('Request', ['channel', 'id'])
+
+
+def _completion(channel, request_id, kind='ATTENDING'):
+    user = User(str(request_id), 'user{}'.format(request_id), '1', '')
+    return Completion(
+        Request(channel, request_id), (kind, 'server', user), time.time())
+
+
+class FakeDiscord:
+    def __init__(self):
+        self.reactions = []
+        self.replies = []
+
+    async def react(self, request):
+        self.reactions.append(request)
+
+    async def reply(self, channel, text):
+        self.replies.append((channel, text))
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def _acknowledge(batches, limiter=None):
+    """Acknowledges batches of completions from another thread."""
+    discord = FakeDiscord()
+    metrics = Metrics()
+
+    async def acknowledge():
+        acknowledger = Acknowledger(asyncio.get_event_loop(), discord.react,
+                                    discord.reply, metrics, limiter)
+
+        def actor():
+            for batch in batches:
+                acknowledger.complete(batch)
+            acknowledger.stop()
+
+        thread = threading.Thread(target=actor)
+        thread.start()
+        await acknowledger.run()
+        thread.join()
+
+    run(acknowledge())
+    return discord, metrics
+
+
+def test_reacts_to_each_request():
+    discord, metrics = _acknowledge([
+        [_completion('general', 1), _completion('general', 1)],
+        [_completion('random', 2)],
+    ])
+
+    assert discord.reactions == [
+        Request('general', 1), Request('random', 2)
+    ]
+    assert discord.replies == []
+    assert metrics.counter('acks_reactions') == 2
+    assert metrics.histogram('request_ack_seconds').count == 2
+
+
+def test_summarizes_bursts():
+    discord, metrics = _acknowledge([
+        [_completion('general', i) for i in range(4)] +
+        [_completion('general', 4, 'NOT_ATTENDING')],
+        [_completion('random', 5)],
+    ])
+
+    assert discord.reactions == [Request('random', 5)]
+    assert discord.replies == [
+        ('general', 'Added nametags for user0, user1, user2, user3.\n'
+         'Cancelled nametags for user4.'),
+    ]
+    assert metrics.histogram('request_ack_seconds').count == 6
+
+
+def test_rate_limiter():
+    now = [0]
+    limiter = RateLimiter(rate=100, burst=2, clock=lambda: now[0])
+
+    async def acquire(n):
+        for _ in range(n):
+            await limiter.acquire()
+
+    run(acquire(2))
+    assert limiter.tokens == 0
+
+    now[0] = 0.015
+    run(acquire(1))
+    assert 0 <= limiter.tokens < 1
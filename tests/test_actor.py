@@ -0,0 +1,325 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import pytest
+from queue import Queue
+import sqlite3
+import time
+
+from nametagbot import User
+from nametagbot import actor
+from nametagbot.actor import Envelope, RosterActor, _next_batch, _retry_busy
+from nametagbot.config import Config
+from nametagbot.data import Roster
+from nametagbot.metrics import Metrics
+
+
+@pytest.fixture
+def config(tmpdir):
+    path = os.path.join(str(tmpdir), 'config.ini')
+    with open(path, 'w') as f:
+        f.write('[files]\nDataDir = {0}/data\nCacheDir = {0}/cache\n'
+                '[bot]\nRosterBatchSize = 3\n'
+                'ProfileDebounce = 0.01\n'.format(str(tmpdir)))
+    return Config(path)
+
+
+def _envelope(message):
+    return Envelope(None, time.time(), message, None)
+
+
+def _run_actor(config, messages, metrics=None):
+    """Runs a roster actor on the messages, until it's asked to quit."""
+    with config.get_spool() as spool:
+        roster_actor = RosterActor(config, metrics or Metrics(), spool)
+        for message in messages:
+            assert roster_actor.submit(message)
+        roster_actor.start()
+        roster_actor.stop()
+        assert len(spool) == 0
+
+
+def test_next_batch_is_bounded_by_size():
+    messages = Queue()
+    for i in range(5):
+        messages.put(_envelope(('ATTENDING', i)))
+
+    assert len(_next_batch(messages, 3, 10)) == 3
+    assert len(_next_batch(messages, 3, 0.01)) == 2
+
+
+def test_next_batch_stops_at_quit():
+    messages = Queue()
+    envelopes = [
+        _envelope(message)
+        for message in [('ATTENDING', 1), ('QUIT', ), ('ATTENDING', 2)]
+    ]
+    for envelope in envelopes:
+        messages.put(envelope)
+
+    assert _next_batch(messages, 10, 10) == envelopes[:2]
+
+
+def test_roster_actor_commits_batches(config):
+    users = [User(str(i), 'user{}'.format(i), '1', '') for i in range(5)]
+    metrics = Metrics()
+    _run_actor(config, [('ATTENDING', 'server{}'.format(int(user.user_id) % 2),
+                         user) for user in users], metrics)
+
+    with config.get_roster('server0') as roster:
+        assert list(roster.attending_users()) == users[::2]
+    with config.get_roster('server1') as roster:
+        assert list(roster.attending_users()) == users[1::2]
+    assert metrics.histogram('roster_batch_size').count == 2
+    assert metrics.histogram('roster_batch_size').max == 3
+    assert metrics.histogram('roster_lag_seconds').count == 6
+    assert metrics.gauge('roster_spool_depth') == 0
+
+
+def test_roster_actor_coalesces_profiles(config):
+    bob = User('1', 'Bob', '1', '')
+    jay = User('2', 'Jay', '1', '')
+    metrics = Metrics()
+    _run_actor(config, [
+        ('PROFILE', 'server', bob),
+        ('PROFILE', 'server', bob._replace(nick='Robert')),
+        ('PROFILE', 'server', jay),
+        ('REMOVED', 'server', jay.user_id),
+    ], metrics)
+
+    with config.get_roster('server') as roster:
+        assert list(roster.all_users()) == [bob._replace(nick='Robert')]
+    assert metrics.counter('roster_profiles_written') == 1
+
+
+def test_roster_actor_debounces_profiles(config):
+    bob = User('1', 'Bob', '1', '')
+    with config.get_spool() as spool:
+        roster_actor = RosterActor(config, Metrics(), spool)
+        roster_actor.start()
+        try:
+            roster_actor.submit(('PROFILE', 'server', bob))
+            with config.get_roster('server') as roster:
+                deadline = time.monotonic() + 5
+                while not list(roster.all_users()):
+                    assert time.monotonic() < deadline
+                    time.sleep(0.01)
+        finally:
+            roster_actor.stop()
+
+
+def test_roster_actor_cancels_attendance(config):
+    bob = User('1', 'Bob', '1', '')
+    _run_actor(config, [
+        ('ATTENDING', 'server', bob),
+        ('NOT_ATTENDING', 'server', bob),
+    ])
+
+    with config.get_roster('server') as roster:
+        assert list(roster.attending_users()) == []
+        assert list(roster.all_users()) == [bob]
+
+
+def test_roster_actor_replays_spool(config):
+    bob = User('1', 'Bob', '1', '')
+    with config.get_spool() as spool:
+        # Left behind by a bot that crashed before committing it.
+        spool.append(('ATTENDING', 'server', bob), time.time())
+
+    _run_actor(config, [])
+
+    with config.get_roster('server') as roster:
+        assert list(roster.attending_users()) == [bob]
+
+
+def test_roster_actor_replays_overflow(config):
+    users = [User(str(i), 'user{}'.format(i), '1', '') for i in range(5)]
+    metrics = Metrics()
+    with config.get_spool() as spool:
+        roster_actor = RosterActor(config, metrics, spool)
+        roster_actor.messages = Queue(maxsize=2)
+        for user in users:
+            assert roster_actor.submit(('ATTENDING', 'server', user))
+        assert not roster_actor.submit(('PROFILE', 'server', users[0]))
+
+        roster_actor.start()
+        roster_actor.stop()
+        assert len(spool) == 0
+
+    with config.get_roster('server') as roster:
+        assert list(roster.attending_users()) == users
+    assert metrics.counter('roster_queue_full') == 4
+
+
+def test_roster_actor_restarts(config, monkeypatch):
+    bob = User('1', 'Bob', '1', '')
+    set_users_attendance = Roster.set_users_attendance
+    failures = []
+
+    def fail_once(self, changes):
+        if not failures:
+            failures.append(changes)
+            raise RuntimeError('simulated failure')
+        set_users_attendance(self, changes)
+
+    monkeypatch.setattr(Roster, 'set_users_attendance', fail_once)
+    monkeypatch.setattr(actor, 'RESTART_DELAY', 0.01)
+    metrics = Metrics()
+    with config.get_spool() as spool:
+        roster_actor = RosterActor(config, metrics, spool)
+        roster_actor.submit(('ATTENDING', 'server', bob))
+        roster_actor.start()
+        try:
+            # Stopping would cancel the restart, so wait for it.
+            deadline = time.monotonic() + 5
+            while len(spool):
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+        finally:
+            roster_actor.stop()
+
+    with config.get_roster('server') as roster:
+        assert list(roster.attending_users()) == [bob]
+    assert metrics.counter('roster_actor_restarts') == 1
+
+
+def test_retry_busy(monkeypatch):
+    monkeypatch.setattr(actor, 'BUSY_DELAY', 0)
+    attempts = []
+
+    def write(value):
+        attempts.append(value)
+        if len(attempts) < 3:
+            raise sqlite3.OperationalError('database is locked')
+        return value
+
+    metrics = Metrics()
+    assert _retry_busy(metrics, write, 42) == 42
+    assert metrics.counter('roster_busy_retries') == 2
+
+    def fail():
+        raise sqlite3.OperationalError('no such table: User')
+
+    with pytest.raises(sqlite3.OperationalError):
+        _retry_busy(metrics, fail)
+    assert metrics.counter('roster_busy_retries') == 2
+
+
+def test_roster_actor_reports_completions(config):
+    bob = User('1', 'Bob', '1', '')
+    completions = []
+    metrics = Metrics()
+    with config.get_spool() as spool:
+        roster_actor = RosterActor(
+            config, metrics, spool, on_commit=completions.extend)
+        roster_actor.submit(('ATTENDING', 'server', bob), token='request')
+        roster_actor.submit(('PROFILE', 'server', bob), token='profile')
+        roster_actor.start()
+        roster_actor.stop()
+
+    assert [(c.token, c.message) for c in completions] == [
+        ('request', ('ATTENDING', 'server', bob)),
+    ]
+    assert metrics.histogram('request_commit_seconds').count == 1
+
+
+def test_roster_actor_skips_noop_writes(config, monkeypatch):
+    bob = User('1', 'Bob', '1', '')
+    with config.get_roster('server') as roster:
+        roster.set_user_attendance(bob, True)
+
+    writes = []
+    set_users_attendance = Roster.set_users_attendance
+
+    def record_writes(self, changes):
+        writes.append(changes)
+        set_users_attendance(self, changes)
+
+    monkeypatch.setattr(Roster, 'set_users_attendance', record_writes)
+    metrics = Metrics()
+    _run_actor(config, [
+        ('ATTENDING', 'server', bob),
+        ('PROFILE', 'server', bob),
+        ('NOT_ATTENDING', 'server', bob),
+        ('ATTENDING', 'server', bob),
+    ], metrics)
+
+    # The first attendance message and the profile change nothing.
+    assert writes == [[(bob, False), (bob, True)]]
+    assert metrics.counter('roster_noop_writes') == 2
+    assert metrics.counter('roster_profiles_written') == 0
+
+
+def test_roster_actor_writes_through_to_index(config):
+    bob = User('1', 'Bob', '1', '')
+    with config.get_spool() as spool:
+        roster_actor = RosterActor(config, Metrics(), spool)
+        roster_actor.submit(('ATTENDING', 'server', bob))
+        roster_actor.submit(('PROFILE', 'other', bob))
+        roster_actor.start()
+        roster_actor.stop()
+
+    index = roster_actor.index
+    assert index.loaded.is_set()
+    assert index.is_attending('server', bob.user_id)
+    assert index.state('other', bob.user_id) == (bob, False)
+
+
+def test_roster_actor_logs_metrics_while_idle(config, monkeypatch):
+    monkeypatch.setattr(actor, 'METRICS_INTERVAL', 0.01)
+    metrics = Metrics()
+    logged = []
+    monkeypatch.setattr(metrics, 'log', lambda: logged.append(True))
+    with config.get_spool() as spool:
+        roster_actor = RosterActor(config, metrics, spool)
+        roster_actor.start()
+        try:
+            deadline = time.monotonic() + 5
+            while not logged:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+        finally:
+            roster_actor.stop()
+
+
+def test_roster_actor_fails_fast_without_roster(config, monkeypatch):
+    def fail(self, server_id=None):
+        raise ValueError('simulated schema error')
+
+    monkeypatch.setattr(Config, 'get_roster', fail)
+    with config.get_spool() as spool:
+        roster_actor = RosterActor(config, Metrics(), spool)
+        with pytest.raises(ValueError):
+            roster_actor.start()
+        roster_actor.stop()
+
+
+def test_roster_actor_stops_while_restarting(config, monkeypatch):
+    def fail(*args):
+        raise RuntimeError('simulated failure')
+
+    monkeypatch.setattr(actor, 'roster_actor', fail)
+    monkeypatch.setattr(actor, 'RESTART_DELAY', 60)
+    metrics = Metrics()
+    with config.get_spool() as spool:
+        roster_actor = RosterActor(config, metrics, spool)
+        roster_actor.messages = Queue(maxsize=1)
+        roster_actor.submit(('PROFILE', 'server', User('1', 'Bob', '1', '')))
+        roster_actor.start()
+
+        start = time.monotonic()
+        roster_actor.stop()
+        assert time.monotonic() - start < 5
+    assert metrics.counter('roster_actor_restarts') == 1
@@ -0,0 +1,130 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import asyncio
+import os.path
+import pytest
+import sqlite3
+
+from nametagbot import User
+from nametagbot.data import AsyncAvatarCache, CDN_PREFIX
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+
+class FakeStream:
+    def __init__(self, body):
+        self.body = body
+
+    async def read(self, n):
+        await asyncio.sleep(0)
+        chunk, self.body = self.body[:n], self.body[n:]
+        return chunk
+
+
+class FakeResponse:
+    def __init__(self, status, body, content_type='image/png'):
+        self.status = status
+        self.reason = 'Reason {}'.format(status)
+        self.headers = {'Content-Type': content_type}
+        self.content = FakeStream(body)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeSession:
+    """Minimal stand-in for an aiohttp.ClientSession."""
+
+    def __init__(self):
+        self.responses = {}
+        self.calls = []
+
+    def add(self, url, status=200, body=PNG, content_type='image/png'):
+        self.responses[url] = (status, body, content_type)
+
+    def get(self, url, headers=None):
+        self.calls.append(url)
+        return FakeResponse(*self.responses[url])
+
+
+@pytest.fixture
+def session():
+    return FakeSession()
+
+
+@pytest.fixture
+def cache(tmpdir, session):
+    return AsyncAvatarCache(
+        os.path.join(str(tmpdir), 'cache'), session=session)
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_get_avatar(cache, session, tmpdir):
+    session.add(
+        CDN_PREFIX + 'avatars/123/avatar1.png', body=PNG + b'imagedata')
+
+    user = User('123', 'foo', '1', 'avatar1')
+    output_path = os.path.join(str(tmpdir), 'out.png')
+    run(cache.get_avatar(user, output_path))
+
+    with open(output_path, 'rb') as f:
+        assert f.read() == PNG + b'imagedata'
+
+
+def test_coalesces_concurrent_requests(cache, session):
+    session.add(CDN_PREFIX + 'avatars/123/avatar1.png')
+
+    user = User('123', 'foo', '1', 'avatar1')
+
+    async def fetch_concurrently():
+        await asyncio.gather(*[cache.cache_avatar(user) for i in range(3)])
+
+    run(fetch_concurrently())
+    run(cache.cache_avatar(user))
+
+    assert len(session.calls) == 1
+
+
+def test_prefetch_reports_failures(cache, session):
+    session.add(CDN_PREFIX + 'avatars/1/avatar.png')
+    session.add(CDN_PREFIX + 'avatars/2/avatar.png', status=404)
+
+    good = User('1', 'foo', '1', 'avatar')
+    bad = User('2', 'bar', '1', 'avatar')
+    failures = run(cache.prefetch([good, bad]))
+
+    assert [user for user, e in failures] == [bad]
+    assert isinstance(failures[0][1], ValueError)
+
+
+def test_close_closes_index_when_session_fails(cache, session):
+    def fail():
+        raise RuntimeError('Event loop is closed')
+
+    session.close = fail
+    with pytest.raises(RuntimeError):
+        run(cache.close())
+    with pytest.raises(sqlite3.ProgrammingError):
+        cache._index.db.execute('SELECT 1;')
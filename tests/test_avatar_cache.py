@@ -12,12 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import io
 import os.path
 import pytest
+import requests
 import responses
 
 from nametagbot import User
-from nametagbot.data import AvatarCache, CDN_PREFIX
+from nametagbot.data import AvatarCache, AvatarFormat, CDN_PREFIX, Roster
+
+PNG = b'\x89PNG\r\n\x1a\n'
 
 
 @pytest.fixture
@@ -32,7 +36,7 @@ def test_get_avatar(cache, tmpdir):
         CDN_PREFIX + 'avatars/123/avatar1.png',
         status=200,
         content_type='image/png',
-        body=b'imagedata')
+        body=PNG + b'imagedata')
 
     user = User('123', 'foo', '1', 'avatar1')
     output_path = os.path.join(str(tmpdir), 'out.png')
@@ -41,7 +45,7 @@ def test_get_avatar(cache, tmpdir):
     with open(output_path, 'rb') as f:
         data = f.read()
 
-    assert data == b'imagedata'
+    assert data == PNG + b'imagedata'
 
 
 @responses.activate
@@ -50,7 +54,8 @@ def test_does_not_request_cached_avatars(cache, tmpdir):
         responses.GET,
         CDN_PREFIX + 'avatars/123/avatar1.png',
         status=200,
-        content_type='image/png')
+        content_type='image/png',
+        body=PNG)
 
     user = User('123', 'foo', '1', 'avatar1')
     for i in range(3):
@@ -66,7 +71,7 @@ def test_fetches_default_for_user_without_avatar(cache, tmpdir):
         CDN_PREFIX + 'embed/avatars/1.png',
         status=200,
         content_type='image/png',
-        body=b'default_avatar_1')
+        body=PNG + b'default_avatar_1')
 
     user = User('123', 'foo', '1', '')
     output_path = os.path.join(str(tmpdir), 'out.png')
@@ -75,7 +80,7 @@ def test_fetches_default_for_user_without_avatar(cache, tmpdir):
     with open(output_path, 'rb') as f:
         data = f.read()
 
-    assert data == b'default_avatar_1'
+    assert data == PNG + b'default_avatar_1'
 
 
 @responses.activate
@@ -101,3 +106,406 @@ def test_unexpected_content_type_raises_exception(cache, tmpdir):
     output_path = os.path.join(str(tmpdir), 'out.png')
     with pytest.raises(ValueError):
         cache.get_avatar(user, output_path)
+
+
+@responses.activate
+def test_prefetch_caches_avatars(cache, tmpdir):
+    for user_id in '123':
+        responses.add(
+            responses.GET,
+            CDN_PREFIX + 'avatars/{}/avatar.png'.format(user_id),
+            status=200,
+            content_type='image/png',
+            body=PNG + user_id.encode())
+
+    users = [User(user_id, 'foo', '1', 'avatar') for user_id in '123']
+    assert cache.prefetch(users, max_workers=2) == []
+    assert len(responses.calls) == 3
+
+    for user in users:
+        output_path = os.path.join(str(tmpdir), 'out.png')
+        cache.get_avatar(user, output_path)
+        with open(output_path, 'rb') as f:
+            assert f.read() == PNG + user.user_id.encode()
+
+    assert len(responses.calls) == 3
+
+
+@responses.activate
+def test_prefetch_fetches_shared_default_avatar_once(cache):
+    responses.add(
+        responses.GET,
+        CDN_PREFIX + 'embed/avatars/1.png',
+        status=200,
+        content_type='image/png',
+        body=PNG)
+
+    users = [User(user_id, 'foo', '1', '') for user_id in '123']
+    assert cache.prefetch(users) == []
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_prefetch_reports_failures(cache):
+    responses.add(
+        responses.GET,
+        CDN_PREFIX + 'avatars/1/avatar.png',
+        status=200,
+        content_type='image/png',
+        body=PNG)
+    responses.add(
+        responses.GET, CDN_PREFIX + 'avatars/2/avatar.png', status=404)
+
+    good = User('1', 'foo', '1', 'avatar')
+    bad = User('2', 'bar', '1', 'avatar')
+    failures = cache.prefetch([good, bad])
+
+    assert [user for user, e in failures] == [bad]
+    assert isinstance(failures[0][1], ValueError)
+
+
+@responses.activate
+def test_refetches_truncated_avatar(cache, tmpdir):
+    responses.add(
+        responses.GET,
+        CDN_PREFIX + 'avatars/123/avatar1.png',
+        status=200,
+        content_type='image/png',
+        body=PNG + b'imagedata')
+
+    user = User('123', 'foo', '1', 'avatar1')
+    output_path = os.path.join(str(tmpdir), 'out.png')
+    cache.get_avatar(user, output_path)
+
+    with open(cache._avatar_cache_path(user), 'r+b') as f:
+        f.truncate(3)
+
+    cache.get_avatar(user, output_path)
+    with open(output_path, 'rb') as f:
+        assert f.read() == PNG + b'imagedata'
+
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_revalidates_with_etag(tmpdir):
+    url = CDN_PREFIX + 'embed/avatars/1.png'
+    responses.add(
+        responses.GET,
+        url,
+        status=200,
+        content_type='image/png',
+        headers={'ETag': '"v1"'},
+        body=PNG + b'default_avatar_1')
+    responses.add(responses.GET, url, status=304)
+
+    cache_path = os.path.join(str(tmpdir), 'cache')
+    user = User('123', 'foo', '1', '')
+    output_path = os.path.join(str(tmpdir), 'out.png')
+    AvatarCache(cache_path).get_avatar(user, output_path)
+    AvatarCache(cache_path, revalidate=True).get_avatar(user, output_path)
+
+    assert len(responses.calls) == 2
+    assert responses.calls[1].request.headers['If-None-Match'] == '"v1"'
+    with open(output_path, 'rb') as f:
+        assert f.read() == PNG + b'default_avatar_1'
+
+
+@responses.activate
+def test_revalidate_replaces_corrupt_avatar(tmpdir):
+    url = CDN_PREFIX + 'avatars/123/avatar1.png'
+    responses.add(
+        responses.GET,
+        url,
+        status=200,
+        content_type='image/png',
+        headers={'ETag': '"v1"'},
+        body=PNG + b'imagedata')
+
+    cache_path = os.path.join(str(tmpdir), 'cache')
+    user = User('123', 'foo', '1', 'avatar1')
+    output_path = os.path.join(str(tmpdir), 'out.png')
+    cache = AvatarCache(cache_path)
+    cache.get_avatar(user, output_path)
+    with open(cache._avatar_cache_path(user), 'wb') as f:
+        f.write(b'garbage!!!!!!!!!!!')
+
+    AvatarCache(cache_path, revalidate=True).get_avatar(user, output_path)
+
+    assert 'If-None-Match' not in responses.calls[1].request.headers
+    with open(output_path, 'rb') as f:
+        assert f.read() == PNG + b'imagedata'
+
+
+@responses.activate
+def test_revalidates_once_per_cache(tmpdir):
+    url = CDN_PREFIX + 'avatars/123/avatar1.png'
+    responses.add(
+        responses.GET, url, status=200, content_type='image/png', body=PNG)
+    responses.add(responses.GET, url, status=304)
+
+    user = User('123', 'foo', '1', 'avatar1')
+    cache = AvatarCache(os.path.join(str(tmpdir), 'cache'), revalidate=True)
+    for i in range(3):
+        cache.get_avatar(user, os.path.join(str(tmpdir), 'out.png'))
+
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_revalidation_releases_connection(tmpdir, monkeypatch):
+    url = CDN_PREFIX + 'avatars/123/avatar1.png'
+    responses.add(
+        responses.GET, url, status=200, content_type='image/png', body=PNG)
+    responses.add(responses.GET, url, status=304)
+
+    closed = []
+    close = requests.Response.close
+
+    def record_close(self):
+        closed.append(self.status_code)
+        close(self)
+
+    monkeypatch.setattr(requests.Response, 'close', record_close)
+    cache_path = os.path.join(str(tmpdir), 'cache')
+    user = User('123', 'foo', '1', 'avatar1')
+    AvatarCache(cache_path).get_avatar(user, str(tmpdir.join('out.png')))
+    AvatarCache(cache_path, revalidate=True).get_avatar(
+        user, str(tmpdir.join('out.png')))
+
+    assert 304 in closed
+
+
+def _add_avatar(user_id, body=PNG + b'imagedata'):
+    responses.add(
+        responses.GET,
+        CDN_PREFIX + 'avatars/{}/avatar.png'.format(user_id),
+        status=200,
+        content_type='image/png',
+        body=body)
+
+
+@responses.activate
+def test_evicts_least_recently_used_entries(tmpdir):
+    for user_id in '1234':
+        _add_avatar(user_id)
+
+    cache = AvatarCache(os.path.join(str(tmpdir), 'cache'), max_entries=2)
+    users = [User(user_id, 'foo', '1', 'avatar') for user_id in '1234']
+    output_path = os.path.join(str(tmpdir), 'out.png')
+    cache.get_avatar(users[0], output_path)
+    cache.get_avatar(users[1], output_path)
+    cache.get_avatar(users[0], output_path)
+    cache.get_avatar(users[2], output_path)
+
+    assert os.path.exists(cache._avatar_cache_path(users[0]))
+    assert not os.path.exists(cache._avatar_cache_path(users[1]))
+    assert os.path.exists(cache._avatar_cache_path(users[2]))
+
+
+@responses.activate
+def test_evicts_to_fit_max_bytes(tmpdir):
+    for user_id in '123':
+        _add_avatar(user_id, body=PNG + b'01')
+
+    cache = AvatarCache(os.path.join(str(tmpdir), 'cache'), max_bytes=25)
+    users = [User(user_id, 'foo', '1', 'avatar') for user_id in '123']
+    for user in users:
+        cache.get_avatar(user, os.path.join(str(tmpdir), 'out.png'))
+
+    assert [os.path.exists(cache._avatar_cache_path(user))
+            for user in users] == [False, True, True]
+
+
+@responses.activate
+def test_sweep_orphans(cache, tmpdir):
+    for user_id in '12':
+        _add_avatar(user_id)
+
+    users = [User(user_id, 'foo', '1', 'avatar') for user_id in '12']
+    assert cache.prefetch(users) == []
+
+    roster = Roster(os.path.join(str(tmpdir), 'roster.db'))
+    roster.update_users([users[0]])
+    assert cache.sweep_orphans(roster) == 1
+    roster.close()
+
+    assert os.path.exists(cache._avatar_cache_path(users[0]))
+    assert not os.path.exists(cache._avatar_cache_path(users[1]))
+
+
+@pytest.mark.parametrize('method', ['auto', 'copy', 'hardlink', 'symlink'])
+@responses.activate
+def test_get_avatar_methods(cache, tmpdir, method):
+    _add_avatar('1')
+
+    user = User('1', 'foo', '1', 'avatar')
+    output_path = os.path.join(str(tmpdir), 'out.png')
+    with open(output_path, 'wb') as f:
+        f.write(b'previous')
+    cache.get_avatar(user, output_path, method=method)
+
+    with open(output_path, 'rb') as f:
+        assert f.read() == PNG + b'imagedata'
+    assert os.path.islink(output_path) == (method == 'symlink')
+
+
+@responses.activate
+def test_refetch_does_not_modify_hardlinked_output(tmpdir):
+    url = CDN_PREFIX + 'avatars/1/avatar.png'
+    for version in [b'v1', b'v2']:
+        responses.add(
+            responses.GET,
+            url,
+            status=200,
+            content_type='image/png',
+            body=PNG + version)
+
+    cache_path = os.path.join(str(tmpdir), 'cache')
+    user = User('1', 'foo', '1', 'avatar')
+    output_path = os.path.join(str(tmpdir), 'out.png')
+    AvatarCache(cache_path).get_avatar(user, output_path, method='hardlink')
+    AvatarCache(cache_path, revalidate=True).get_avatar(
+        user, os.path.join(str(tmpdir), 'out2.png'))
+
+    with open(output_path, 'rb') as f:
+        assert f.read() == PNG + b'v1'
+
+
+@pytest.mark.parametrize('method', ['auto', 'hardlink'])
+@responses.activate
+def test_get_avatar_again_leaves_no_temporary_files(cache, tmpdir, method):
+    _add_avatar('1')
+
+    user = User('1', 'foo', '1', 'avatar')
+    output_dir = tmpdir.mkdir('out')
+    for i in range(2):
+        cache.get_avatar(user, str(output_dir.join('1.png')), method=method)
+
+    assert os.listdir(str(output_dir)) == ['1.png']
+
+
+def test_get_avatar_rejects_unknown_method(cache, tmpdir):
+    with open(cache._avatar_cache_path(User('1', 'foo', '1', '')), 'wb'):
+        pass
+
+    with pytest.raises(ValueError):
+        cache.get_avatar(
+            User('1', 'foo', '1', ''),
+            os.path.join(str(tmpdir), 'out.png'),
+            method='teleport')
+
+
+@responses.activate
+def test_rejects_non_png_avatar(cache, tmpdir):
+    _add_avatar('1', body=b'<html>not a png</html>')
+
+    user = User('1', 'foo', '1', 'avatar')
+    with pytest.raises(ValueError):
+        cache.get_avatar(user, os.path.join(str(tmpdir), 'out.png'))
+
+    assert os.listdir(cache.cache_path) == ['index.db']
+
+
+@responses.activate
+def test_rejects_oversized_avatar(tmpdir):
+    _add_avatar('1', body=PNG + b'x' * 100)
+
+    cache = AvatarCache(
+        os.path.join(str(tmpdir), 'cache'), max_avatar_bytes=64)
+    user = User('1', 'foo', '1', 'avatar')
+    with pytest.raises(ValueError):
+        cache.get_avatar(user, os.path.join(str(tmpdir), 'out.png'))
+
+    assert os.listdir(cache.cache_path) == ['index.db']
+
+
+def _png(size, color=(255, 0, 0, 255)):
+    Image = pytest.importorskip('PIL.Image')
+    output = io.BytesIO()
+    Image.new('RGBA', size, color).save(output, 'PNG')
+    return output.getvalue()
+
+
+@responses.activate
+def test_normalizes_avatar(cache, tmpdir):
+    Image = pytest.importorskip('PIL.Image')
+    _add_avatar('1', body=_png((256, 256)))
+
+    user = User('1', 'foo', '1', 'avatar')
+    output_path = os.path.join(str(tmpdir), 'out.png')
+    cache.get_avatar(user, output_path, avatar_format=AvatarFormat(64, True))
+
+    with Image.open(output_path) as image:
+        assert image.size == (64, 64)
+        assert image.getpixel((0, 0))[3] == 0
+        assert image.getpixel((32, 32)) == (255, 0, 0, 255)
+
+    # The original is still cached, alongside the normalized variant.
+    cache.get_avatar(user, output_path)
+    with Image.open(output_path) as image:
+        assert image.size == (256, 256)
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_sweep_orphans_keeps_variants_of_live_avatars(cache, tmpdir):
+    pytest.importorskip('PIL.Image')
+    _add_avatar('1', body=_png((16, 16)))
+
+    user = User('1', 'foo', '1', 'avatar')
+    cache.get_avatar(
+        user,
+        os.path.join(str(tmpdir), 'out.png'),
+        avatar_format=AvatarFormat(8, False))
+
+    roster = Roster(os.path.join(str(tmpdir), 'roster.db'))
+    roster.update_users([user])
+    assert cache.sweep_orphans(roster) == 0
+    roster.close()
+
+
+@responses.activate
+def test_requests_avatar_size(tmpdir):
+    for size in [64, 512]:
+        responses.add(
+            responses.GET,
+            CDN_PREFIX + 'avatars/1/avatar.png?size={}'.format(size),
+            status=200,
+            content_type='image/png',
+            body=PNG + str(size).encode())
+
+    cache_path = os.path.join(str(tmpdir), 'cache')
+    user = User('1', 'foo', '1', 'avatar')
+    output_path = os.path.join(str(tmpdir), 'out.png')
+    for size in [64, 512, 64]:
+        AvatarCache(cache_path, size=size).get_avatar(user, output_path)
+        with open(output_path, 'rb') as f:
+            assert f.read() == PNG + str(size).encode()
+
+    assert [call.request.url for call in responses.calls] == [
+        CDN_PREFIX + 'avatars/1/avatar.png?size=64',
+        CDN_PREFIX + 'avatars/1/avatar.png?size=512',
+    ]
+
+
+def test_rejects_invalid_avatar_size(tmpdir):
+    with pytest.raises(ValueError):
+        AvatarCache(os.path.join(str(tmpdir), 'cache'), size=100)
+
+
+@responses.activate
+def test_batch_defers_eviction(tmpdir):
+    for user_id in '1234':
+        _add_avatar(user_id)
+
+    cache = AvatarCache(os.path.join(str(tmpdir), 'cache'), max_entries=2)
+    users = [User(user_id, 'foo', '1', 'avatar') for user_id in '1234']
+    cache.get_avatar(users[0], os.path.join(str(tmpdir), 'out.png'))
+    with cache.batch():
+        assert cache.prefetch(users[1:]) == []
+        assert all(os.path.exists(cache._avatar_cache_path(user))
+                   for user in users)
+
+    assert [os.path.exists(cache._avatar_cache_path(user))
+            for user in users] == [False, True, True, True]
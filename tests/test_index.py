@@ -0,0 +1,49 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from nametagbot import User
+from nametagbot.data import Roster
+from nametagbot.index import RosterIndex
+
+BOB = User('1', 'Bob', '1', 'avatar1')
+JAY = User('2', 'Jay', '1', '')
+
+
+def test_index_loads_roster():
+    with Roster(':memory:', server_id='a') as roster:
+        roster.set_users_attendance([(BOB, True), (JAY, False)])
+        roster.for_server('b').set_user_attendance(JAY, True)
+
+        index = RosterIndex()
+        assert not index.loaded.is_set()
+        index.load(roster)
+
+    assert index.loaded.is_set()
+    assert len(index) == 3
+    assert index.state('a', BOB.user_id) == (BOB, True)
+    assert index.state('a', JAY.user_id) == (JAY, False)
+    assert index.is_attending('b', JAY.user_id)
+    assert not index.is_attending('b', BOB.user_id)
+    assert index.profile('b', BOB.user_id) is None
+
+
+def test_index_writes_through():
+    index = RosterIndex()
+    index.set_users_attendance('a', [(BOB, True), (JAY, True)])
+    index.set_users_attendance('a', [(JAY, False)])
+    index.update_users('a', [BOB._replace(nick='Robert')])
+
+    assert index.state('a', BOB.user_id) == (BOB._replace(nick='Robert'),
+                                             True)
+    assert index.state('a', JAY.user_id) == (JAY, False)
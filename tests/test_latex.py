@@ -0,0 +1,183 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import pytest
+import responses
+
+from nametagbot import User
+from nametagbot.cmd_latex import (BOXES_PER_PAGE, _avatar_size, _shard_users,
+                                  _write_latex)
+from nametagbot.config import Config
+from nametagbot.data import AvatarFormat, CDN_PREFIX
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+
+def test_shard_users_splits_whole_pages():
+    users = list(range(5 * BOXES_PER_PAGE + 3))
+    shards = _shard_users(users, 3)
+
+    assert [len(shard) for shard in shards] == [
+        2 * BOXES_PER_PAGE, 2 * BOXES_PER_PAGE, BOXES_PER_PAGE + 3
+    ]
+    assert sum(shards, []) == users
+
+
+def test_shard_users_with_fewer_pages_than_shards():
+    users = list(range(3))
+    assert _shard_users(users, 4) == [users]
+
+
+def test_shard_users_without_users():
+    assert _shard_users([], 2) == [[]]
+
+
+def test_avatar_size_prefers_requested_then_configured():
+    avatar_format = AvatarFormat(100, False)
+    assert _avatar_size(64, 256, avatar_format) == 64
+    assert _avatar_size(None, 256, avatar_format) == 256
+    assert _avatar_size(None, None, avatar_format) == 128
+    assert _avatar_size(None, None, None) is None
+
+
+@pytest.fixture
+def config(tmpdir):
+    path = os.path.join(str(tmpdir), 'config.ini')
+    with open(path, 'w') as f:
+        f.write('[files]\nDataDir = {0}/data\nCacheDir = {0}/cache\n'.format(
+            str(tmpdir)))
+    return Config(path)
+
+
+def _add_attendees(config, count, start=0):
+    with config.get_roster() as roster:
+        for i in range(start, start + count):
+            user_id = str(1000 + i)
+            responses.add(
+                responses.GET,
+                CDN_PREFIX + 'avatars/{}/avatar.png'.format(user_id),
+                status=200,
+                content_type='image/png',
+                body=PNG + user_id.encode())
+            roster.set_user_attendance(
+                User(user_id, 'user{:03}'.format(i), '1', 'avatar'), True)
+
+
+@responses.activate
+def test_incremental_rebuild_rewrites_changed_shards(config, tmpdir):
+    output_dir = os.path.join(str(tmpdir), 'out')
+    _add_attendees(config, BOXES_PER_PAGE + 1)
+    assert _write_latex(config, output_dir, shards=2) == [
+        'nametags-000.tex', 'nametags-001.tex'
+    ]
+
+    # Mark both shards, and pretend they've been compiled.
+    for name in ['nametags-000', 'nametags-001']:
+        with open(os.path.join(output_dir, name + '.tex'), 'a') as f:
+            f.write('% unchanged\n')
+        open(os.path.join(output_dir, name + '.pdf'), 'w').close()
+
+    _add_attendees(config, 1, start=BOXES_PER_PAGE + 1)
+    _write_latex(config, output_dir, shards=2, incremental=True)
+
+    with open(os.path.join(output_dir, 'nametags-000.tex')) as f:
+        assert f.read().endswith('% unchanged\n')
+    assert os.path.exists(os.path.join(output_dir, 'nametags-000.pdf'))
+
+    with open(os.path.join(output_dir, 'nametags-001.tex')) as f:
+        assert 'user009' in f.read()
+    assert not os.path.exists(os.path.join(output_dir, 'nametags-001.pdf'))
+
+    avatar_requests = len(responses.calls)
+    _write_latex(config, output_dir, shards=2, incremental=True)
+    assert len(responses.calls) == avatar_requests
+    assert len(os.listdir(os.path.join(output_dir, 'avatars'))) == 10
+
+
+@responses.activate
+def test_templates_are_cached_and_overridable(config, tmpdir):
+    _add_attendees(config, 1)
+    _write_latex(config, os.path.join(str(tmpdir), 'out'))
+    assert os.listdir(os.path.join(config.cache_path, 'templates'))
+
+    template_dir = os.path.join(str(tmpdir), 'templates')
+    os.mkdir(template_dir)
+    with open(os.path.join(template_dir, 'nametags.tex'), 'w') as f:
+        f.write('%%for user, _ in users\n\\VAR{user.nick}!\n%%endfor\n')
+
+    output_dir = os.path.join(str(tmpdir), 'custom')
+    _write_latex(config, output_dir, template_dir=template_dir)
+    with open(os.path.join(output_dir, 'nametags.tex')) as f:
+        assert f.read() == 'user000!\n'
+
+
+@responses.activate
+def test_unavailable_avatars_fall_back_to_default(config, tmpdir):
+    _add_attendees(config, 1)
+    url = CDN_PREFIX + 'avatars/2000/avatar.png'
+    responses.add(responses.GET, url, status=500)
+    responses.add(
+        responses.GET,
+        CDN_PREFIX + 'embed/avatars/1.png',
+        status=200,
+        content_type='image/png',
+        body=PNG + b'default')
+    with config.get_roster() as roster:
+        roster.set_user_attendance(User('2000', 'user999', '1', 'avatar'),
+                                   True)
+        roster.set_user_attendance(User('3000', 'user998', '2', ''), True)
+
+    output_dir = os.path.join(str(tmpdir), 'out')
+    _write_latex(config, output_dir)
+
+    assert [call.request.url for call in responses.calls].count(url) == 1
+    with open(os.path.join(output_dir, 'avatars', '2000.png'), 'rb') as f:
+        assert f.read() == PNG + b'default'
+    assert sorted(os.listdir(os.path.join(output_dir, 'avatars'))) == [
+        '1000.png', '2000.png'
+    ]
+
+
+@responses.activate
+def test_build_keeps_its_avatars_in_a_bounded_cache(tmpdir):
+    path = os.path.join(str(tmpdir), 'config.ini')
+    with open(path, 'w') as f:
+        f.write('[files]\nDataDir = {0}/data\nCacheDir = {0}/cache\n'
+                'MaxCacheEntries = 2\n'.format(str(tmpdir)))
+    config = Config(path)
+    _add_attendees(config, 6)
+
+    _write_latex(config, os.path.join(str(tmpdir), 'out'))
+    assert len(responses.calls) == 6
+
+
+@responses.activate
+def test_incremental_rebuild_with_new_options_cleans_up(config, tmpdir):
+    output_dir = os.path.join(str(tmpdir), 'out')
+    _add_attendees(config, 2 * BOXES_PER_PAGE + 1)
+    assert len(_write_latex(config, output_dir, shards=3)) == 3
+
+    with config.get_roster() as roster:
+        roster.set_user_attendance(User('1000', 'user000', '1', 'avatar'),
+                                   False)
+    assert _write_latex(
+        config, output_dir, shards=1, incremental=True) == ['nametags.tex']
+
+    assert sorted(name for name in os.listdir(output_dir)
+                  if name.endswith('.tex')) == ['nametags.tex']
+    assert not os.path.exists(
+        os.path.join(output_dir, 'avatars', '1000.png'))
+    assert len(os.listdir(os.path.join(output_dir, 'avatars'))) == (
+        2 * BOXES_PER_PAGE)
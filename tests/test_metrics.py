@@ -0,0 +1,40 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from nametagbot.metrics import Histogram, Metrics
+
+
+def test_histogram():
+    histogram = Histogram([1, 10, 100])
+    for value in [0.5, 2, 3, 50, 500]:
+        histogram.observe(value)
+
+    assert histogram.count == 5
+    assert histogram.min == 0.5
+    assert histogram.max == 500
+    assert histogram.quantile(0.5) == 10
+    assert histogram.quantile(1) == 500
+
+
+def test_metrics():
+    metrics = Metrics()
+    metrics.increment('messages')
+    metrics.increment('messages', 2)
+    metrics.set_gauge('depth', 7)
+    metrics.observe('latency', 0.01)
+
+    assert metrics.counter('messages') == 3
+    assert metrics.counter('unknown') == 0
+    assert metrics.gauge('depth') == 7
+    assert metrics.histogram('latency').count == 1
@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-from nametagbot.chat import parse_content
+from collections import namedtuple
+
+from nametagbot import User
+from nametagbot.chat import parse_content, parse_message
+from nametagbot.metrics import Metrics
 
 
 def test_no_action():
@@ -31,3 +35,102 @@ def test_add_other_user():
                                                               '<@456>')
     assert parse_content('<@123> make a nametag for <@456>') == ('ATTENDING',
                                                                  '<@456>')
+
+
+def test_add_several_users():
+    assert parse_content('<@1> and <@2> want nametags') == ('ATTENDING',
+                                                            '<@1>', '<@2>')
+    assert parse_content('<@9> make nametags for <@1>, <@!2> and me') == (
+        'ATTENDING', '<@1>', '<@!2>', 'me')
+
+
+def test_not_attending():
+    assert parse_content("<@9> I don't want a nametag") == ('NOT_ATTENDING',
+                                                            'I')
+    assert parse_content('<@9> <@456> is not going') == ('NOT_ATTENDING',
+                                                         '<@456>')
+    assert parse_content('<@9> cancel my nametag') == ('NOT_ATTENDING', 'my')
+    assert parse_content("<@9> cancel <@456>'s tag") == ('NOT_ATTENDING',
+                                                         '<@456>')
+
+
+def test_status():
+    assert parse_content('<@9> am I attending?') == ('STATUS', 'I')
+    assert parse_content('<@9> is <@456> on the list?') == ('STATUS',
+                                                            '<@456>')
+    assert parse_content('<@9> does <@456> have a nametag?') == ('STATUS',
+                                                                 '<@456>')
+
+
+Server = namedtuple('Server', ['id'])
+Member = namedtuple('Member',
+                    ['id', 'name', 'nick', 'discriminator', 'avatar'])
+Message = namedtuple('Message', ['server', 'author', 'mentions', 'content'])
+
+BOT = Member('9', 'nametagbot', None, '0001', '')
+BOB = Member('1', 'bob', 'Bob', '0002', 'avatar1')
+JAY = Member('2', 'jay', None, '0003', 'avatar2')
+
+
+def test_parse_message():
+    message = Message(
+        Server('100'), BOB, [BOT, JAY],
+        '<@9> make nametags for me and <@2>')
+    assert parse_message(message, ['100'], BOT) == [
+        ('ATTENDING', '100', User('1', 'Bob', '0002', 'avatar1')),
+        ('ATTENDING', '100', User('2', 'jay', '0003', 'avatar2')),
+    ]
+    assert parse_message(message, [], BOT) == parse_message(
+        message, ['100'], BOT)
+    assert parse_message(message, ['200'], BOT) == []
+
+
+def test_parse_message_ignores_bot_mention():
+    message = Message(
+        Server('100'), BOB, [BOT], '<@9>, I want a nametag')
+    assert parse_message(message, ['100'], BOT) == [
+        ('ATTENDING', '100', User('1', 'Bob', '0002', 'avatar1')),
+    ]
+
+    message = Message(
+        Server('100'), BOB, [BOT, JAY], '<@9>, <@2> wants a nametag')
+    assert parse_message(message, ['100'], BOT) == [
+        ('ATTENDING', '100', User('2', 'jay', '0003', 'avatar2')),
+    ]
+
+
+def test_parse_message_ignores_other_messages():
+    assert parse_message(
+        Message(Server('100'), BOB, [], 'I want a nametag'), [], BOT) == []
+    assert parse_message(
+        Message(Server('100'), BOB, [JAY], '<@2> I want a nametag'), [],
+        BOT) == []
+    assert parse_message(
+        Message(Server('100'), BOB, [BOT], '<@9> hello'), [], BOT) == []
+
+
+def test_parse_message_direct_message():
+    message = Message(None, BOB, [BOT], '<@9> I want a nametag')
+    assert parse_message(message, ['100'], BOT) == [
+        ('ATTENDING', '100', User('1', 'Bob', '0002', 'avatar1')),
+    ]
+    assert parse_message(message, frozenset(['100']), BOT) == parse_message(
+        message, ['100'], BOT)
+    assert parse_message(message, ['100', '200'], BOT) == []
+
+
+def test_parse_message_metrics():
+    metrics = Metrics()
+    for content in ['hello', '<@9> hello', '<@9> <@3> wants a nametag',
+                    '<@9> I want a nametag']:
+        parse_message(
+            Message(Server('100'), BOB, [BOT], content), ['100'], BOT,
+            metrics)
+    parse_message(
+        Message(Server('200'), BOB, [BOT], '<@9> I want a nametag'),
+        ['100'], BOT, metrics)
+
+    for outcome in ['not_addressed', 'no_intent', 'no_target', 'accepted',
+                    'other_server']:
+        assert metrics.counter('chat_messages_' + outcome) == 1
+        assert metrics.histogram('chat_{}_seconds'.format(outcome)).count == 1
@@ -12,11 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+from concurrent.futures import ThreadPoolExecutor
 import os
 import pytest
+import sqlite3
 
 from nametagbot import User
-from nametagbot.data import Roster
+from nametagbot.data import (Roster, SyncProgress, UpdateCounts, UserColumns,
+                             UserPage)
 
 
 @pytest.fixture
@@ -110,3 +113,386 @@ def test_accepts_multi_digit_user_id(roster):
     user = User('123', 'Bob', '456', 'avatar1')
     roster.set_user_attendance(user, True)
     assert list(roster.attending_users()) == [user]
+
+
+def test_all_users(roster):
+    bob = User('1', 'Bob', '1', 'avatar1')
+    jay = User('2', 'Jay', '1', 'avatar2')
+    roster.set_user_attendance(jay, True)
+    roster.update_users([bob])
+
+    assert list(roster.all_users()) == [bob, jay]
+
+
+def test_set_users_attendance(roster):
+    bob = User('1', 'Bob', '1', 'avatar1')
+    jay = User('2', 'Jay', '1', 'avatar2')
+    roster.set_user_attendance(jay, True)
+
+    roster.set_users_attendance([(bob, True), (jay, False)])
+    assert list(roster.attending_users()) == [bob]
+
+
+def test_uses_wal_journal(roster):
+    assert roster.db.execute('PRAGMA journal_mode;').fetchone() == ('wal', )
+
+
+def test_applies_busy_timeout_first(roster):
+    db = sqlite3.connect(':memory:')
+    statements = []
+    db.set_trace_callback(statements.append)
+    roster._configure(db)
+    db.close()
+
+    assert statements[0] == 'PRAGMA busy_timeout = 5000;'
+
+
+def test_rejects_invalid_pragma(tmpdir):
+    with pytest.raises(ValueError):
+        Roster(os.path.join(str(tmpdir), 'roster.db'), synchronous='maybe')
+
+
+def test_readers_do_not_block_writer(roster):
+    bob = User('1', 'Bob', '1', 'avatar1')
+    jay = User('2', 'Jay', '1', 'avatar2')
+    roster.set_user_attendance(bob, True)
+
+    users = roster.attending_users()
+    assert next(users) == bob
+    roster.set_user_attendance(jay, True)
+    assert list(users) == []
+
+    assert list(roster.attending_users()) == [bob, jay]
+
+
+def test_concurrent_readers(roster):
+    bob = User('1', 'Bob', '1', 'avatar1')
+    roster.set_user_attendance(bob, True)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(lambda _: list(roster.attending_users()), range(32)))
+
+    assert results == [[bob]] * 32
+
+
+def test_read_only_connections(roster):
+    with roster.reader() as db:
+        with pytest.raises(sqlite3.OperationalError):
+            db.execute('DELETE FROM User;')
+
+
+def test_update_users_counts_changes(roster):
+    bob = User('1', 'Bob', '1', 'avatar1')
+    jay = User('2', 'Jay', '1', None)
+    cara = User('3', 'Cara', '1', 'avatar3')
+    assert roster.update_users([bob, jay]) == (2, 0, 0)
+
+    counts = roster.update_users(
+        [bob, jay._replace(avatar='avatar2'), cara])
+    assert counts == UpdateCounts(inserted=1, updated=1, unchanged=1)
+    assert list(roster.all_users()) == [
+        bob, cara, jay._replace(avatar='avatar2')
+    ]
+
+    assert roster.update_users([bob, bob]) == (0, 0, 1)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def timed_roster(tmpdir, clock):
+    r = Roster(os.path.join(str(tmpdir), 'roster.db'), clock=clock)
+    yield r
+    r.close()
+
+
+def _event_count(roster):
+    return roster.db.execute('SELECT COUNT(*) FROM Event;').fetchone()[0]
+
+
+def test_logs_only_changes(timed_roster):
+    bob = User('1', 'Bob', '1', 'avatar1')
+    timed_roster.set_user_attendance(bob, True)
+    timed_roster.set_user_attendance(bob, True)
+    timed_roster.update_users([bob])
+    assert _event_count(timed_roster) == 2
+
+    timed_roster.update_users([bob._replace(nick='Robert')])
+    timed_roster.set_user_attendance(bob, False)
+    assert _event_count(timed_roster) == 5
+
+
+def test_attending_users_at(timed_roster, clock):
+    bob = User('1', 'Bob', '1', 'avatar1')
+    jay = User('2', 'Jay', '1', 'avatar2')
+
+    timed_roster.set_user_attendance(bob, True)
+    clock.now += 10
+    timed_roster.set_user_attendance(jay, True)
+    clock.now += 10
+    timed_roster.update_users([bob._replace(avatar='avatar3')])
+    timed_roster.set_user_attendance(jay, False)
+
+    assert timed_roster.attending_users_at(999) == []
+    assert timed_roster.attending_users_at(1000) == [bob]
+    assert timed_roster.attending_users_at(1010) == [bob, jay]
+    assert timed_roster.attending_users_at(1020) == [
+        bob._replace(avatar='avatar3')
+    ]
+
+
+def test_compact(timed_roster, clock):
+    bob = User('1', 'Bob', '1', 'avatar1')
+    jay = User('2', 'Jay', '1', 'avatar2')
+
+    timed_roster.set_user_attendance(bob, True)
+    clock.now += 10
+    assert timed_roster.compact(clock.now - 100) == 0
+
+    clock.now += 10
+    timed_roster.set_user_attendance(jay, True)
+    clock.now += 10
+    assert timed_roster.compact(1015) == 2
+    assert _event_count(timed_roster) == 2
+
+    assert timed_roster.attending_users_at(1015) == [bob]
+    assert timed_roster.attending_users_at(1020) == [bob, jay]
+    with pytest.raises(ValueError):
+        timed_roster.attending_users_at(1005)
+
+
+def test_rebuild(timed_roster, clock):
+    bob = User('1', 'Bob', '1', 'avatar1')
+    jay = User('2', 'Jay', '1', 'avatar2')
+    timed_roster.set_user_attendance(bob, True)
+    timed_roster.compact(clock.now)
+    timed_roster.set_user_attendance(jay, True)
+
+    timed_roster.db.execute('DELETE FROM Attendance;')
+    timed_roster.rebuild()
+    assert list(timed_roster.attending_users()) == [bob, jay]
+
+
+def test_existing_roster_starts_history_with_snapshot(tmpdir, clock):
+    path = os.path.join(str(tmpdir), 'roster.db')
+    bob = User('1', 'Bob', '1', 'avatar1')
+    with Roster(path, clock=clock) as roster:
+        roster.set_user_attendance(bob, True)
+        roster.db.execute('DROP TABLE Event;')
+        roster.db.execute('DELETE FROM sqlite_sequence;')
+
+    clock.now += 10
+    with Roster(path, clock=clock) as roster:
+        assert roster.attending_users_at(clock.now) == [bob]
+        with pytest.raises(ValueError):
+            roster.attending_users_at(1000)
+
+
+def test_query_users_pages(roster):
+    users = [
+        User(str(i), nick, '1', 'avatar')
+        for i, nick in enumerate(['bob', 'Cara', 'alice', 'Bob', 'dan'])
+    ]
+    roster.update_users(users)
+
+    page = roster.query_users(limit=2)
+    assert page.users == [users[2], users[0]]
+    page = roster.query_users(after=page.next_key, limit=2)
+    assert page.users == [users[3], users[1]]
+    page = roster.query_users(after=page.next_key, limit=2)
+    assert page == (UserPage([users[4]], None))
+
+    assert list(roster.iter_users(page_size=2)) == [
+        users[2], users[0], users[3], users[1], users[4]
+    ]
+
+
+def test_query_users_filters(timed_roster, clock):
+    roster = timed_roster
+    bob = User('1', 'Bob', '1', 'avatar1')
+    bobby = User('2', 'bobby', '1', '')
+    zed = User('3', 'Zed', '1', 'avatar3')
+    roster.update_users([bob, bobby, zed])
+    roster.set_user_attendance(bobby, True)
+    clock.now += 10
+    roster.update_users([zed._replace(avatar='avatar4')])
+
+    def query(**filters):
+        return [user.user_id for user in roster.iter_users(**filters)]
+
+    assert query(attending=True) == ['2']
+    assert query(attending=False) == ['1', '3']
+    assert query(nick_prefix='BO') == ['1', '2']
+    assert query(nick_prefix='z') == ['3']
+    assert query(custom_avatar=True) == ['1', '3']
+    assert query(custom_avatar=False) == ['2']
+    assert query(updated_since=clock.now) == ['3']
+    assert query(nick_prefix='b', attending=False) == ['1']
+
+
+def test_query_users_nick_prefix_before_letters(roster):
+    roster.update_users([
+        User('1', '@alice', '1', ''),
+        User('2', '[x]', '1', ''),
+        User('3', '_bob', '1', ''),
+        User('4', 'Alice', '1', ''),
+    ])
+    assert [user.nick for user in roster.iter_users(nick_prefix='@')] == [
+        '@alice'
+    ]
+    assert [user.nick for user in roster.iter_users(nick_prefix='[')] == [
+        '[x]'
+    ]
+
+
+def test_query_users_uses_nick_index(roster):
+    plan = roster.db.execute('''
+        EXPLAIN QUERY PLAN
+        SELECT user_id FROM User
+        WHERE server_id = ?
+        ORDER BY nick COLLATE NOCASE ASC, user_id ASC;
+    ''', ('1', )).fetchall()
+    assert 'User_nick' in str(plan)
+
+
+def test_servers_are_partitioned(roster):
+    bob = User('1', 'Bob', '1', 'avatar1')
+    other = roster.for_server('2')
+    roster.update_users([bob])
+    other.update_users([bob._replace(nick='Robert')])
+    other.set_user_attendance(bob._replace(nick='Robert'), True)
+
+    assert list(roster.all_users()) == [bob]
+    assert list(roster.attending_users()) == []
+    assert list(other.attending_users()) == [bob._replace(nick='Robert')]
+    assert roster.server_ids() == ['', '2']
+
+
+def test_partitions_existing_roster(tmpdir):
+    path = os.path.join(str(tmpdir), 'roster.db')
+    db = sqlite3.connect(path)
+    db.executescript('''
+        CREATE TABLE User
+            (user_id TEXT NOT NULL,
+             nick TEXT,
+             discriminator TEXT,
+             avatar TEXT,
+             PRIMARY KEY (user_id));
+        CREATE TABLE Attendance
+            (user_id TEXT NOT NULL UNIQUE,
+             FOREIGN KEY (user_id) REFERENCES User (user_id));
+        INSERT INTO User VALUES ('1', 'Bob', '1', 'avatar1');
+        INSERT INTO User VALUES ('2', 'Jay', '1', 'avatar2');
+        INSERT INTO Attendance VALUES ('1');
+    ''')
+    db.close()
+
+    with Roster(path, server_id='123') as roster:
+        assert roster.server_ids() == ['123']
+        assert list(roster.attending_users()) == [
+            User('1', 'Bob', '1', 'avatar1')
+        ]
+        assert len(list(roster.all_users())) == 2
+
+    with Roster(path, server_id='123') as roster:
+        assert roster.server_ids() == ['123']
+
+
+def test_refuses_to_partition_without_server(tmpdir):
+    path = os.path.join(str(tmpdir), 'roster.db')
+    db = sqlite3.connect(path)
+    db.executescript('''
+        CREATE TABLE User
+            (user_id TEXT NOT NULL,
+             nick TEXT,
+             discriminator TEXT,
+             avatar TEXT,
+             PRIMARY KEY (user_id));
+        INSERT INTO User VALUES ('1', 'Bob', '1', 'avatar1');
+    ''')
+    db.close()
+
+    with pytest.raises(ValueError):
+        Roster(path)
+
+    with Roster(path, server_id='123') as roster:
+        assert roster.server_ids() == ['123']
+
+
+def test_sync_users_in_chunks(timed_roster, clock):
+    users = [User(str(i), 'user{}'.format(i), '1', '') for i in range(5)]
+    counts = timed_roster.sync_users(iter(users), chunk_size=2)
+    assert counts == UpdateCounts(5, 0, 0)
+    assert list(timed_roster.all_users()) == users
+    assert timed_roster.sync_progress() is None
+
+
+def test_sync_users_resumes(timed_roster, clock):
+    users = [User(str(i), 'user{}'.format(i), '1', '') for i in range(5)]
+
+    def interrupted():
+        yield from users[:3]
+        raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        timed_roster.sync_users(interrupted(), chunk_size=2)
+    assert timed_roster.sync_progress() == SyncProgress(1000, 2)
+
+    clock.now += 10
+    counts = timed_roster.sync_users(users, chunk_size=2)
+    assert counts == UpdateCounts(3, 0, 2)
+    assert timed_roster.sync_progress() is None
+
+
+def test_is_attending(roster):
+    bob = User('1', 'Bob', '1', 'avatar1')
+    assert not roster.is_attending(bob.user_id)
+    roster.set_user_attendance(bob, True)
+    assert roster.is_attending(bob.user_id)
+    assert not roster.for_server('2').is_attending(bob.user_id)
+
+
+def test_export_columns(roster):
+    bob = User('1', 'Bob', '0001', 'avatar1')
+    jay = User('22', 'jay', '0001', None)
+    amy = User('333', 'Amy', '0002', '')
+    roster.set_users_attendance([(bob, True), (jay, True), (amy, False)])
+
+    columns = roster.export_columns()
+    assert list(columns) == [amy, bob, jay]
+    assert columns.user_ids.typecode == 'Q'
+    assert columns.discriminators[1] is columns.discriminators[2]
+    assert len(columns) == 3
+    assert columns[-1] == jay
+    assert list(columns[1:]) == [bob, jay]
+
+    assert list(roster.export_columns(attending=True)) == [bob, jay]
+    assert list(roster.export_columns(attending=False)) == [amy]
+    assert list(roster.for_server('2').export_columns()) == []
+
+
+def test_user_columns_keep_other_user_ids():
+    columns = UserColumns()
+    columns.append('1', 'Bob', '1', '')
+    columns.append('01', 'Jay', '1', '')
+    columns.append('a', 'Amy', '1', '')
+    assert [user.user_id for user in columns] == ['1', '01', 'a']
+
+
+def test_user_columns_keep_non_ascii_digits():
+    columns = UserColumns()
+    columns.append('\N{SUPERSCRIPT TWO}', 'Bob', '1', '')
+    assert isinstance(columns.user_ids, list)
+    assert list(columns)[0].user_id == '\N{SUPERSCRIPT TWO}'
@@ -0,0 +1,40 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+
+from nametagbot import User
+from nametagbot.spool import Spool
+
+BOB = User('1', 'Bob', '1', 'avatar1')
+JAY = User('2', 'Jay', '1', '')
+
+
+def test_spool_survives_reopening(tmpdir):
+    path = os.path.join(str(tmpdir), 'spool.db')
+    with Spool(path) as spool:
+        first = spool.append(('ATTENDING', 'server', BOB), 1000)
+        second = spool.append(('NOT_ATTENDING', 'server', JAY), 1001)
+
+    with Spool(path) as spool:
+        assert len(spool) == 2
+        assert spool.pending() == [
+            (first, 1000, ('ATTENDING', 'server', BOB)),
+            (second, 1001, ('NOT_ATTENDING', 'server', JAY)),
+        ]
+        assert spool.pending(after=first) == spool.pending()[1:]
+        assert spool.pending(limit=1) == spool.pending()[:1]
+
+        spool.ack([first])
+        assert [seq for seq, _, _ in spool.pending()] == [second]